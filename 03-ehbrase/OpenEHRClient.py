@@ -24,10 +24,16 @@
 
 
 import base64
+import codecs
+import concurrent.futures
 import enum
+import io
 import json
+import os
+import re
 import requests
 import requests.auth
+import threading
 
 
 # Enumeration that encodes the various file formats supported by the
@@ -38,6 +44,108 @@ class CompositionFormat(enum.Enum):
     SIMPLIFIED_JSON_STRUCTURED = 3
 
 
+# AQL query that lists the patients that are registered in the CDR
+# using the "MonitoredPatient.v0" template, together with the composer
+# of the registration and the name of the patient
+_LIST_PATIENTS_AQL = ('SELECT c/composer/name, e/ehr_id/value, p/items[at0001]/value/value '
+                      'FROM EHR e CONTAINS COMPOSITION c CONTAINS CLUSTER p[openEHR-EHR-CLUSTER.person.v1] '
+                      "WHERE c/archetype_details/template_id/value='MonitoredPatient.v0'")
+
+
+# Regular expression that matches the content of a JSON string, until
+# its closing quote (excluded) or an incomplete escape sequence
+_JSON_STRING_CONTENT = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+
+# Look for the base64 string that is associated with the path "keys"
+# in a stream of JSON data, then decode this string chunk by chunk
+# into the binary file object "output". The path lists the keys of
+# the nested objects from the root of the JSON data, the arrays being
+# traversed transparently: A key only matches at its own nesting
+# depth. The function returns the number of bytes that were written.
+def _decodeBase64Field(chunks, keys, output):
+    textDecoder = codecs.getincrementaldecoder('utf-8')()
+    # Containers that are currently open: "None" for an array, or a
+    # pair [current key, whether a key is expected] for an object
+    stack = []
+    inString = False
+    found = False
+    buffer = ''
+    pending = ''
+    written = 0
+
+    for chunk in chunks:
+        buffer += textDecoder.decode(chunk)
+        i = 0
+
+        while not found and i < len(buffer):
+            if inString:
+                # Skip the content of a string that is not of interest
+                end = _JSON_STRING_CONTENT.match(buffer, i).end()
+                if end < len(buffer) and buffer[end] == '"':
+                    inString = False
+                    i = end + 1
+                    continue
+                else:
+                    i = end  # Wait for the end of the string
+                    break
+
+            c = buffer[i]
+            top = stack[-1] if len(stack) > 0 else None
+
+            if c == '"':
+                if top != None and top[1]:
+                    # Keys are decoded as a whole (the slashes might be escaped)
+                    end = _JSON_STRING_CONTENT.match(buffer, i + 1).end()
+                    if end < len(buffer) and buffer[end] == '"':
+                        top[0] = json.loads(buffer[i : end + 1])
+                        top[1] = False
+                        i = end + 1
+                        continue
+                    else:
+                        break  # Wait for the end of the key
+                elif list(map(lambda x: x[0], filter(lambda x: x != None, stack))) == keys:
+                    found = True
+                else:
+                    inString = True
+            elif c == '{':
+                stack.append([ None, True ])
+            elif c == '[':
+                stack.append(None)
+            elif c == '}' or c == ']':
+                stack.pop()
+            elif c == ',' and top != None:
+                top[1] = True
+
+            i += 1
+
+        buffer = buffer[i :]
+
+        if found:
+            end = buffer.find('"')
+            if end == -1:
+                data = buffer
+            else:
+                data = buffer[0 : end]
+            buffer = ''
+
+            # Some JSON serializers escape the slashes of base64
+            pending += data.replace('\\', '')
+
+            # Decode the largest prefix that contains full groups of 4 characters
+            length = len(pending) - len(pending) % 4
+            if length > 0:
+                written += output.write(base64.b64decode(pending[0 : length]))
+                pending = pending[length :]
+
+            if end != -1:
+                if len(pending) > 0:
+                    written += output.write(base64.b64decode(pending))
+                return written
+
+    raise Exception('Cannot find the multimedia content in the composition')
+
+
 # Class that represents a connection to some openEHR CDR (clinical
 # data repository), including EHRbase
 class OpenEHRClient:
@@ -123,6 +231,20 @@ class OpenEHRClient:
         return r.json()
 
 
+    # Compile the web template of a template into a
+    # "CompositionCodec" object, which can be used to create and read
+    # compositions deriving from this template, in the simplified
+    # flat or structured JSON formats. The "fields" argument is a
+    # dictionary that maps the attribute names of the records of the
+    # codec to the paths of the fields inside the composition,
+    # without the template prefix (for instance, "{ 'magnitude' :
+    # 'temperature/temperature|magnitude' }"). If "fields" is "None",
+    # all the fields of the template are compiled. The paths are
+    # validated once, when the codec is compiled.
+    def compileTemplate(self, templateId, fields = None):
+        return CompositionCodec(self.getTemplate(templateId), fields)
+
+
     # Return a sample composition for the given template. The file
     # format for the composition can be specified.
     def getSampleComposition(self, templateId, format = CompositionFormat.SIMPLIFIED_JSON_FLAT):
@@ -200,44 +322,125 @@ class OpenEHRClient:
         return list(map(lambda x: x[0], aql ['rows']))
 
 
+    # Internal method to iterate over the identifiers of the EHRs,
+    # by pages of at most "pageSize" identifiers sorted in increasing
+    # order. The EHRs are paged by their identifiers (and not using
+    # OFFSET), which makes it possible to delete the EHRs while
+    # iterating, and to resume the iteration after a given EHR.
+    def _iterateEHRPages(self, composer = None, pageSize = 1000, after = None):
+        if pageSize <= 0:
+            raise Exception('The page size must be positive')
+
+        while True:
+            conditions = []
+            params = {}
+
+            if composer == None:
+                query = 'SELECT e/ehr_id/value FROM EHR e'
+            else:
+                query = 'SELECT DISTINCT e/ehr_id/value FROM EHR e CONTAINS COMPOSITION c'
+                conditions.append('c/composer/name=$composer')
+                params['composer'] = composer
+
+            if after != None:
+                conditions.append('e/ehr_id/value>$after')
+                params['after'] = after
+
+            if len(conditions) > 0:
+                query += ' WHERE ' + ' AND '.join(conditions)
+
+            query += ' ORDER BY e/ehr_id/value ASC LIMIT %d' % pageSize
+
+            page = list(map(lambda x: x[0], self.executeAQL(query, params) ['rows']))
+            if len(page) > 0:
+                yield page
+
+            if len(page) < pageSize:
+                return  # We are done
+            else:
+                after = page[-1]
+
+
+    # Iterate over the identifiers of all the EHRs that are stored in
+    # the openEHR CDR, sorted in increasing order. Contrarily to
+    # "listEHRs()", the identifiers are retrieved by pages of
+    # "pageSize" items. If "composer" is provided, only the EHRs that
+    # contain at least one composition from this composer are
+    # returned. If "after" is provided, the iteration starts after
+    # the EHR with this identifier.
+    def iterateEHRs(self, composer = None, pageSize = 1000, after = None):
+        for page in self._iterateEHRPages(composer, pageSize, after):
+            for ehrId in page:
+                yield ehrId
+
+
+    # List the patients that are registered in the CDR using the
+    # "MonitoredPatient.v0" template, using one single AQL query. The
+    # method returns a list of triples (composer name, EHR identifier,
+    # patient name). If "composer" is provided, only the patients that
+    # were registered by this composer are returned.
+    def listPatients(self, composer = None):
+        query = _LIST_PATIENTS_AQL
+        params = {}
+
+        if composer != None:
+            query += ' AND c/composer/name=$composer'
+            params['composer'] = composer
+
+        return list(map(lambda x: (x[0], x[1], x[2]),
+                        self.executeAQL(query, params) ['rows']))
+
+
+    # List the EHRs that contain at least one composition, together
+    # with the composers of these compositions, using one single AQL
+    # query. The method returns a list of pairs (composer name, EHR
+    # identifier). If "composer" is provided, only the EHRs that
+    # contain compositions from this composer are returned.
+    def listComposerEHRs(self, composer = None):
+        query = 'SELECT DISTINCT c/composer/name, e/ehr_id/value FROM EHR e CONTAINS COMPOSITION c'
+        params = {}
+
+        if composer != None:
+            query += ' WHERE c/composer/name=$composer'
+            params['composer'] = composer
+
+        return list(map(lambda x: (x[0], x[1]),
+                        self.executeAQL(query, params) ['rows']))
+
+
     # List the identifiers of all the compositions that are stored
-    # inside the EHR whose identifier is provided in argument.
-    def listCompositions(self, ehrId):
-        aql = self.executeAQL('SELECT c/uid/value FROM EHR e CONTAINS COMPOSITION c WHERE e/ehr_id/value=$ehrId', {
+    # inside the EHR whose identifier is provided in argument. If
+    # "composer" is provided, only the compositions from this composer
+    # are returned.
+    def listCompositions(self, ehrId, composer = None):
+        query = 'SELECT c/uid/value FROM EHR e CONTAINS COMPOSITION c WHERE e/ehr_id/value=$ehrId'
+        params = {
             'ehrId' : ehrId,
-        })
+        }
+
+        if composer != None:
+            query += ' AND c/composer/name=$composer'
+            params['composer'] = composer
+
+        aql = self.executeAQL(query, params)
         return list(map(lambda x: x[0], aql ['rows']))
 
 
-    # Return the content of one composition, given the identifier of
-    # the composition and the identifier of its parent EHR. The
-    # returned file format can possibly be fine-tuned.
-    def getComposition(self, ehrId, compositionId, format = CompositionFormat.SIMPLIFIED_JSON_FLAT):
+    # Internal method to get the URL of one composition in the given format
+    def _getCompositionUrl(self, ehrId, compositionId, format):
         if format == CompositionFormat.CANONICAL_JSON:
-            url = '%s/openehr/v1/ehr/%s/composition/%s' % (self.url, ehrId, compositionId)
+            return '%s/openehr/v1/ehr/%s/composition/%s' % (self.url, ehrId, compositionId)
         elif format == CompositionFormat.SIMPLIFIED_JSON_FLAT:
-            url = '%s/ecis/v1/composition/%s?format=FLAT' % (self.url, compositionId)
+            return '%s/ecis/v1/composition/%s?format=FLAT' % (self.url, compositionId)
         elif format == CompositionFormat.SIMPLIFIED_JSON_STRUCTURED:
-            url = '%s/ecis/v1/composition/%s?format=STRUCTURED' % (self.url, compositionId)
+            return '%s/ecis/v1/composition/%s?format=STRUCTURED' % (self.url, compositionId)
         else:
             raise Exception('Enumeration out of range')
 
-        r = requests.get(url,
-                         auth = self._getAuthentication(),
-                         headers = {
-                             'Accept' : 'application/json',
-                         })
-
-        r.raise_for_status()
-        return r.json()
-
-
-    # Add one composition to the parent EHR whose identifier is
-    # provided as an argument. The caller must also specify the
-    # identifier of the template to be used (which is needed for the
-    # simplified formats), as well as the file format that is used to
-    # define the composition.
-    def addComposition(self, ehrId, templateId, composition, format = CompositionFormat.SIMPLIFIED_JSON_FLAT):
+    # Internal method to POST a new composition, whose content is
+    # provided by "data" (either a string, or a generator of strings
+    # for a chunked upload)
+    def _postComposition(self, ehrId, templateId, data, format):
         if format == CompositionFormat.CANONICAL_JSON:
             url = '%s/openehr/v1/ehr/%s/composition' % (self.url, ehrId)
         elif format == CompositionFormat.SIMPLIFIED_JSON_FLAT:
@@ -249,7 +452,7 @@ class OpenEHRClient:
 
         r = requests.post(url,
                           auth = self._getAuthentication(),
-                          data = json.dumps(composition),
+                          data = data,
                           headers = {
                               'Content-Type' : 'application/json',
                               'Accept' : 'application/json',
@@ -263,6 +466,29 @@ class OpenEHRClient:
             return r.json() ['compositionUid']
 
 
+    # Return the content of one composition, given the identifier of
+    # the composition and the identifier of its parent EHR. The
+    # returned file format can possibly be fine-tuned.
+    def getComposition(self, ehrId, compositionId, format = CompositionFormat.SIMPLIFIED_JSON_FLAT):
+        r = requests.get(self._getCompositionUrl(ehrId, compositionId, format),
+                         auth = self._getAuthentication(),
+                         headers = {
+                             'Accept' : 'application/json',
+                         })
+
+        r.raise_for_status()
+        return r.json()
+
+
+    # Add one composition to the parent EHR whose identifier is
+    # provided as an argument. The caller must also specify the
+    # identifier of the template to be used (which is needed for the
+    # simplified formats), as well as the file format that is used to
+    # define the composition.
+    def addComposition(self, ehrId, templateId, composition, format = CompositionFormat.SIMPLIFIED_JSON_FLAT):
+        return self._postComposition(ehrId, templateId, json.dumps(composition), format)
+
+
     # Properly fill the content a field of type "MULTIMEDIA" in a
     # composition of type simplified structured JSON. This method is
     # for advanced use cases, and is not used in the course.
@@ -321,6 +547,111 @@ class OpenEHRClient:
         return content
 
 
+    # Add one composition containing a field of type "MULTIMEDIA" to
+    # the parent EHR whose identifier is provided as an argument, and
+    # return the identifier of the new composition. The "field"
+    # argument is the same as in "setMultimediaContentIntoFlat()" or
+    # "setMultimediaContentIntoStructured()", depending on "format".
+    # Contrarily to these two methods, the binary "content" (either
+    # "bytes" or a binary file object) is base64-encoded chunk by
+    # chunk while the request body is uploaded, so that neither the
+    # full base64 string nor the full JSON body are ever stored in
+    # memory. If "content" is a file object that is not seekable, its
+    # "size" must be provided.
+    def addCompositionWithMultimedia(self, ehrId, templateId, composition, field, content, mimeType,
+                                     format = CompositionFormat.SIMPLIFIED_JSON_FLAT,
+                                     size = None, chunkSize = 3 * 65536):
+        if isinstance(content, (bytes, bytearray)):
+            size = len(content)
+            content = io.BytesIO(content)
+        elif size == None:
+            if not content.seekable():
+                raise Exception('The size of the multimedia content must be provided')
+            position = content.tell()
+            size = content.seek(0, io.SEEK_END) - position
+            content.seek(position)
+
+        # Base64 encodes groups of 3 bytes: Chunks whose size is a
+        # multiple of 3 can be encoded independently
+        chunkSize = max(3, chunkSize - chunkSize % 3)
+
+        # The composition is serialized with a placeholder instead of
+        # the base64 data, then split around this placeholder
+        placeholder = '@@%s@@' % base64.b16encode(os.urandom(16)).decode('ascii')
+
+        if format == CompositionFormat.SIMPLIFIED_JSON_FLAT:
+            composition = dict(composition)
+            composition.pop('%s/content' % field, None)
+            composition['%s/content|size' % field] = size
+            composition['%s/content|data' % field] = placeholder
+            composition['%s/content|mediatype' % field] = mimeType
+            serialized = json.dumps(composition)
+        elif format == CompositionFormat.SIMPLIFIED_JSON_STRUCTURED:
+            assert(len(field) == 1)
+            previous = field[0].get('content')
+            field[0]['content'] = [
+                {
+                    '|size' : size,
+                    '|data' : placeholder,
+                    '|mediatype' : mimeType,
+                }
+            ]
+            try:
+                serialized = json.dumps(composition)
+            finally:
+                if previous == None:
+                    del field[0]['content']
+                else:
+                    field[0]['content'] = previous
+        else:
+            raise Exception('Only the simplified JSON formats are supported')
+
+        (prefix, suffix) = serialized.split(placeholder)
+
+        def generateBody():
+            yield prefix.encode('utf-8')
+            while True:
+                chunk = content.read(chunkSize)
+                if len(chunk) == 0:
+                    break
+                yield base64.b64encode(chunk)
+            yield suffix.encode('utf-8')
+
+        return self._postComposition(ehrId, templateId, generateBody(), format)
+
+
+    # Retrieve the content of a field of type "MULTIMEDIA" from a
+    # composition stored in the openEHR CDR, and write it into the
+    # binary file object "output". The composition is downloaded as a
+    # stream, and its base64 data is decoded chunk by chunk, so that
+    # the full composition is never stored in memory. The "field"
+    # argument is the path to the field (e.g. "basic/attachment"),
+    # both in the flat and structured formats. The method returns the
+    # number of bytes that were written.
+    def getMultimediaContentStream(self, ehrId, compositionId, field, output,
+                                   format = CompositionFormat.SIMPLIFIED_JSON_FLAT,
+                                   chunkSize = 65536):
+        if format == CompositionFormat.SIMPLIFIED_JSON_FLAT:
+            keys = [ '%s/content|data' % field ]
+        elif format == CompositionFormat.SIMPLIFIED_JSON_STRUCTURED:
+            keys = field.split('/') + [ 'content', '|data' ]
+        else:
+            raise Exception('Only the simplified JSON formats are supported')
+
+        r = requests.get(self._getCompositionUrl(ehrId, compositionId, format),
+                         auth = self._getAuthentication(),
+                         stream = True,
+                         headers = {
+                             'Accept' : 'application/json',
+                         })
+        r.raise_for_status()
+
+        try:
+            return _decodeBase64Field(r.iter_content(chunk_size = chunkSize), keys, output)
+        finally:
+            r.close()
+
+
     # Delete the given EHR from an EHRbase server. This function is
     # not available in the generic openEHR REST API (i.e., it is
     # specific to EHRbase). The connection also requires the
@@ -332,6 +663,34 @@ class OpenEHRClient:
         r.raise_for_status()
 
 
+    # Delete one composition from an EHRbase server, given its
+    # identifier (possibly versioned, as returned by AQL in
+    # "c/uid/value"). This function is specific to EHRbase, and has
+    # the same requirements as "deleteEHR()".
+    def deleteComposition(self, ehrId, compositionId):
+        r = requests.delete('%s/admin/ehr/%s/composition/%s' % (self.url, ehrId, compositionId.split('::') [0]),
+                            auth = self._getAuthentication())
+        r.raise_for_status()
+
+
+    # Internal method to delete the compositions of one composer from
+    # an EHR. The whole EHR is only deleted if all its compositions
+    # belong to this composer, so that the data of the other composers
+    # sharing the CDR is kept.
+    def _resetComposerEHR(self, ehrId, composer):
+        rows = self.executeAQL('SELECT c/uid/value, c/composer/name FROM EHR e CONTAINS COMPOSITION c '
+                               'WHERE e/ehr_id/value=$ehrId', {
+                                   'ehrId' : ehrId,
+                               }) ['rows']
+
+        owned = list(map(lambda x: x[0], filter(lambda x: x[1] == composer, rows)))
+        if len(owned) == len(rows):
+            self.deleteEHR(ehrId)
+        else:
+            for compositionId in owned:
+                self.deleteComposition(ehrId, compositionId)
+
+
     # Delete the given template from an EHRbase server. This function
     # is not available in the generic openEHR REST API (i.e., it is
     # specific to EHRbase). The connection also requires the
@@ -349,9 +708,294 @@ class OpenEHRClient:
     # requires the "ehrbase-admin" credentials, and EHRbase must have
     # been started with the "ADMINAPI_ACTIVE" environment variable set
     # to "true".
-    def reset(self):
-        for ehrId in self.listEHRs():
-            self.deleteEHR(ehrId)
+    #
+    # The EHRs are retrieved by pages of "pageSize" identifiers, and
+    # each page is deleted by at most "workers" concurrent threads. If
+    # "composer" is provided, only the compositions from this composer
+    # are deleted, and the templates are kept: An EHR is only deleted
+    # as a whole if all its compositions come from this composer
+    # (other composers may have written into the same EHRs). If
+    # provided, the "progress" callback is invoked after each page
+    # with the total number of processed EHRs and the identifier of
+    # the last processed EHR. As the deleted compositions disappear
+    # from the CDR, an interrupted reset is resumed by simply calling
+    # this method again. The method returns the number of processed
+    # EHRs.
+    def reset(self, workers = 8, composer = None, pageSize = 1000, progress = None):
+        count = 0
+
+        if composer == None:
+            reset = self.deleteEHR
+        else:
+            reset = lambda ehrId: self._resetComposerEHR(ehrId, composer)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+            for page in self._iterateEHRPages(composer, pageSize):
+                # Consume the results to propagate the exceptions, if any
+                list(executor.map(reset, page))
+
+                count += len(page)
+                if progress != None:
+                    progress(count, page[-1])
+
+            if composer == None:
+                list(executor.map(self.deleteTemplate, self.listTemplates()))
+
+        return count
+
+
+
+# In-memory index that maps each composer to the EHRs containing
+# compositions from this composer, and each of these EHRs to the name
+# of its patient. This is useful if one openEHR CDR is shared by
+# multiple tenants (i.e., composers), as the EHRs of one composer can
+# be listed without scanning the compositions of the other composers.
+# The index is built using one single AQL query by "load()", then it
+# must be kept up-to-date by the caller using "addPatient()" and
+# "addEHR()" each time a composition is created.
+class ComposerIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._composers = {}  # Composer name => { EHR identifier => patient name }
+
+    # Rebuild the index from the content of the openEHR CDR. If
+    # "composer" is provided, only this composer is indexed. The EHRs
+    # where a composer has created compositions are indexed as well,
+    # even if the patient was registered by another composer.
+    def load(self, client, composer = None):
+        composers = {}
+
+        for (composerName, ehrId) in client.listComposerEHRs(composer):
+            composers.setdefault(composerName, {}).setdefault(ehrId, None)
+
+        for (composerName, ehrId, patientName) in client.listPatients(composer):
+            composers.setdefault(composerName, {}) [ehrId] = patientName
+
+        with self._lock:
+            self._composers = composers
+
+    # Record that the composer has registered a patient in the given EHR.
+    def addPatient(self, composer, ehrId, patientName):
+        with self._lock:
+            self._composers.setdefault(composer, {}) [ehrId] = patientName
+
+    # Record that the composer has created a composition in the given
+    # EHR. The name of the patient is unknown if the EHR was not
+    # registered by this composer.
+    def addEHR(self, composer, ehrId):
+        with self._lock:
+            self._composers.setdefault(composer, {}).setdefault(ehrId, None)
+
+    # Check whether the composer has created compositions in the given EHR.
+    def hasEHR(self, composer, ehrId):
+        with self._lock:
+            return ehrId in self._composers.get(composer, {})
+
+    # List the identifiers of the EHRs containing compositions from the composer.
+    def listEHRs(self, composer):
+        with self._lock:
+            return list(self._composers.get(composer, {}).keys())
+
+    # List the patients that were registered by the composer, as pairs
+    # (EHR identifier, patient name).
+    def listPatients(self, composer):
+        with self._lock:
+            return list(filter(lambda x: x[1] != None,
+                               self._composers.get(composer, {}).items()))
+
+
+
+# One field of a composition, as compiled by "CompositionCodec". The
+# "segments" are the identifiers of the nodes of the web template from
+# the root of the composition to the field (the root excluded), and
+# "suffix" is the name of the attribute of the field (e.g.,
+# "magnitude"), or "None" if the field has a single value.
+class CompositionField:
+    __slots__ = ('name', 'flatKey', 'segments', 'suffix', 'rmType', 'inputType')
+
+    def __init__(self, name, flatKey, segments, suffix, rmType, inputType):
+        self.name = name
+        self.flatKey = flatKey
+        self.segments = segments
+        self.suffix = suffix
+        self.rmType = rmType
+        self.inputType = inputType
+
+
+# Codec that converts between the compositions deriving from one
+# template (in the simplified flat or structured JSON formats) and
+# lightweight records whose attributes correspond to the fields of
+# interest. The codec is compiled once from the web template (as
+# returned by "OpenEHRClient.getTemplate()"): The paths of the fields
+# are validated and formatted at that time, so that encoding and
+# decoding compositions afterwards does not involve any formatting.
+# Records are created by "newRecord()", and use "__slots__" to reduce
+# their memory footprint. The missing fields are set to "None".
+class CompositionCodec:
+
+    def __init__(self, template, fields = None):
+        webTemplate = template.get('webTemplate', template)
+        root = webTemplate['tree']
+
+        self.templateId = webTemplate.get('templateId')
+        self.root = root['id']
+
+        if fields == None:
+            fields = {}
+            for path in self._listPaths(root, ''):
+                fields[re.sub(r'[^0-9a-zA-Z_]', '_', path)] = path
+
+        self.fields = []
+        for (name, path) in fields.items():
+            if not name.isidentifier():
+                raise Exception('Invalid name for a field: %s' % name)
+            self.fields.append(self._compileField(root, name, path))
+
+        self._record = type('%sRecord' % re.sub(r'[^0-9a-zA-Z_]', '_', self.root),
+                            (object, ), {
+                                '__slots__' : tuple(map(lambda x: x.name, self.fields)),
+                            })
+        self._flatKeys = tuple(map(lambda x: (x.name, x.flatKey), self.fields))
+
+    # Internal method to list the paths of all the fields in the tree
+    # of a web template
+    def _listPaths(self, node, prefix):
+        result = []
+
+        for child in node.get('children', []):
+            path = prefix + child['id']
+
+            for item in child.get('inputs', []):
+                if 'suffix' in item:
+                    result.append('%s|%s' % (path, item['suffix']))
+                else:
+                    result.append(path)
+
+            result += self._listPaths(child, path + '/')
+
+        return result
+
+    # Internal method to resolve the path of a field in the tree of a
+    # web template
+    def _compileField(self, root, name, path):
+        if '|' in path:
+            (path, suffix) = path.split('|', 1)
+        else:
+            suffix = None
+
+        node = root
+        flatKey = self.root
+        segments = []
+
+        for segment in path.split('/'):
+            # The index of multiple occurrences can be omitted in the
+            # paths, it always refers to the first occurrence
+            (segment, _, index) = segment.partition(':')
+            if index not in [ '', '0' ]:
+                raise Exception('Only the first occurrence of a node is supported: %s' % path)
+
+            children = list(filter(lambda x: x['id'] == segment, node.get('children', [])))
+            if len(children) != 1:
+                raise Exception('Unknown path in template %s: %s' % (self.root, path))
+
+            node = children[0]
+            segments.append(node['id'])
+
+            if node.get('max', 1) == 1:
+                flatKey += '/%s' % node['id']
+            else:
+                flatKey += '/%s:0' % node['id']
+
+        inputs = list(filter(lambda x: x.get('suffix') == suffix, node.get('inputs', [])))
+        if len(inputs) != 1:
+            raise Exception('Unknown field in template %s: %s' % (self.root, path))
+
+        if suffix != None:
+            flatKey += '|%s' % suffix
+
+        return CompositionField(name, flatKey, tuple(segments), suffix,
+                                node.get('rmType'), inputs[0].get('type'))
+
+    # Create a new record. The values of the fields can be provided
+    # as keyword arguments.
+    def newRecord(self, **values):
+        record = self._record()
+        for field in self.fields:
+            setattr(record, field.name, values.pop(field.name, None))
+
+        if len(values) > 0:
+            raise Exception('Unknown fields: %s' % ', '.join(values.keys()))
+
+        return record
+
+    # Convert a record into a composition in the simplified flat JSON
+    # format. The fields set to "None" are ignored.
+    def toFlat(self, record):
+        composition = {}
+        for (name, flatKey) in self._flatKeys:
+            value = getattr(record, name)
+            if value != None:
+                composition[flatKey] = value
+        return composition
+
+    # Convert a composition in the simplified flat JSON format into a
+    # record. The composition can also be the full answer of
+    # "OpenEHRClient.getComposition()".
+    def fromFlat(self, composition):
+        if 'composition' in composition:
+            composition = composition['composition']
+
+        record = self._record()
+        for (name, flatKey) in self._flatKeys:
+            setattr(record, name, composition.get(flatKey))
+        return record
+
+    # Convert a record into a composition in the simplified
+    # structured JSON format. The fields set to "None" are ignored.
+    def toStructured(self, record):
+        content = {}
+
+        for field in self.fields:
+            value = getattr(record, field.name)
+            if value == None:
+                continue
+
+            node = content
+            for segment in field.segments[0 : -1]:
+                node = node.setdefault(segment, [ {} ]) [0]
+
+            if field.suffix == None:
+                node[field.segments[-1]] = [ value ]
+            else:
+                node.setdefault(field.segments[-1], [ {} ]) [0]['|' + field.suffix] = value
+
+        return {
+            self.root : content,
+        }
+
+    # Convert a composition in the simplified structured JSON format
+    # into a record. The composition can also be the full answer of
+    # "OpenEHRClient.getComposition()".
+    def fromStructured(self, composition):
+        if 'composition' in composition:
+            composition = composition['composition']
+
+        content = composition[self.root]
+        record = self._record()
+
+        for field in self.fields:
+            node = content
+            for segment in field.segments:
+                items = node.get(segment) if isinstance(node, dict) else None
+                if not items:
+                    node = None
+                    break
+                node = items[0]
+
+            if node != None and field.suffix != None:
+                node = node.get('|' + field.suffix) if isinstance(node, dict) else None
+
+            setattr(record, field.name, node)
 
-        for templateId in self.listTemplates():
-            self.deleteTemplate(templateId)
+        return record
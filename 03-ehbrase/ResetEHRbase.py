@@ -38,6 +38,17 @@ parser.add_argument('--username',
 parser.add_argument('--password',
                     default = 'EvenMoreSecretPassword',
                     help = 'Password to the REST API')
+parser.add_argument('--workers',
+                    type = int,
+                    default = 8,
+                    help = 'Number of EHRs that are deleted concurrently')
+parser.add_argument('--composer',
+                    default = None,
+                    help = 'Only delete the compositions of this composer (the templates are kept)')
+parser.add_argument('--page-size',
+                    type = int,
+                    default = 1000,
+                    help = 'Number of EHRs that are retrieved at once')
 
 args = parser.parse_args()
 
@@ -45,4 +56,15 @@ client = OpenEHRClient.OpenEHRClient(url = args.url,
                                      username = args.username,
                                      password = args.password)
 
-client.reset()
+def progress(count, lastEhrId):
+    print('Processed %d EHRs (last: %s)' % (count, lastEhrId), flush = True)
+
+count = client.reset(workers = args.workers,
+                     composer = args.composer,
+                     pageSize = args.page_size,
+                     progress = progress)
+
+if args.composer == None:
+    print('Done, %d EHRs were deleted' % count)
+else:
+    print('Done, %d EHRs were cleaned' % count)
@@ -29,6 +29,18 @@ app = flask.Flask(__name__)
 
 
 global_credentials = None
+global_index = OpenEHRClient.ComposerIndex()
+global_basic_codec = None
+
+# Fields of the "Basic.v0" compositions that are used by this application
+BASIC_FIELDS = {
+    'composer' : 'composer|name',
+    'temperature' : 'temperature/temperature|magnitude',
+    'unit' : 'temperature/temperature|unit',
+    'time' : 'temperature/time',
+    'territory' : 'territory|code',
+    'terminology' : 'territory|terminology',
+}
 
 def get_composer_name():
     return global_credentials['openehr-composer']
@@ -79,6 +91,12 @@ def app_initialize(credentials, pathToResources):
         ehr_client.addTemplate(os.path.join(pathToResources, 'Basic.v0.opt'))
     if 'MonitoredPatient.v0' not in templates:
         ehr_client.addTemplate(os.path.join(pathToResources, 'MonitoredPatient.v0.opt'))
+
+    global global_basic_codec
+    global_basic_codec = ehr_client.compileTemplate('Basic.v0', BASIC_FIELDS)
+
+    # Index the patients of this composer, using one single AQL query
+    global_index.load(ehr_client, get_composer_name())
     
     
 
@@ -132,6 +150,8 @@ def create_patient():
 
     composition_uid = ehr_client.addComposition(ehr_id, 'MonitoredPatient.v0', composition)
 
+    global_index.addPatient(get_composer_name(), ehr_id, patient_name)
+
     return flask.jsonify({'ehr-id': ehr_id})
 
 
@@ -180,17 +200,18 @@ def record_temperature():
     
     ehr_client = OpenEHRClient.OpenEHRClient(global_credentials['url'], global_credentials['username'], global_credentials['password'])
 
-    composition = {
-        'basic/composer|name' : get_composer_name(),
-        'basic/temperature/temperature|magnitude' : temperature,
-        'basic/temperature/time' : time,
-        'basic/temperature/temperature|unit' : 'Cel',
-        'basic/territory|code' : 'BE',
-        'basic/territory|terminology' : 'ISO_3166-1'
-    }
+    composition = global_basic_codec.toFlat(global_basic_codec.newRecord(
+        composer = get_composer_name(),
+        temperature = temperature,
+        time = time,
+        unit = 'Cel',
+        territory = 'BE',
+        terminology = 'ISO_3166-1'))
 
     composition_uid = ehr_client.addComposition(ehr_id, 'Basic.v0', composition)
 
+    global_index.addEHR(get_composer_name(), ehr_id)
+
     return flask.jsonify({'composition-uid': composition_uid})
 
 
@@ -211,26 +232,13 @@ def list_patients():
     # Hint: If your code is too slow, try using AQL instead of a
     # "homemade" loop over the EHR and compositions.
 
-    
-    ehr_client = OpenEHRClient.OpenEHRClient(global_credentials['url'], global_credentials['username'], global_credentials['password'])
-
-    ehr_ids = ehr_client.listEHRs()
-    
     patients = []
 
-    for ehr_id in ehr_ids:
-        compositions = ehr_client.listCompositions(ehr_id)
-
-        for composition_id in compositions:
-            composition = ehr_client.getComposition(ehr_id, composition_id, OpenEHRClient.CompositionFormat.SIMPLIFIED_JSON_FLAT)    
-            #pprint.pprint(composition)
-            curr_composition = composition['composition']
-            if composition['templateId'] == 'MonitoredPatient.v0' and curr_composition['monitoredpatient.v0/composer|name'] == get_composer_name():
-                patients.append({
-                    'ehr-id': ehr_id,
-                    'patient-name': curr_composition['monitoredpatient.v0/demographics_container/person/name']
-                })
-                
+    for (ehr_id, patient_name) in global_index.listPatients(get_composer_name()):
+        patients.append({
+            'ehr-id': ehr_id,
+            'patient-name': patient_name
+        })
 
     return flask.jsonify(patients)
 
@@ -263,21 +271,23 @@ def list_temperatures():
     ehr_client = OpenEHRClient.OpenEHRClient(global_credentials['url'], global_credentials['username'], global_credentials['password'])
 
     ehr_id = flask.request.get_json().get('ehr-id')
-    
-    compositions = ehr_client.listCompositions(ehr_id)
+
+    if not global_index.hasEHR(get_composer_name(), ehr_id):
+        return flask.jsonify([])  # No composition from this composer in this EHR
+
+    # Only list the compositions from this composer
+    compositions = ehr_client.listCompositions(ehr_id, get_composer_name())
     temperatures = []
 
     for composition_id in compositions:
         composition = ehr_client.getComposition(ehr_id, composition_id, OpenEHRClient.CompositionFormat.SIMPLIFIED_JSON_FLAT)
 
         if composition['templateId'] == 'Basic.v0':
-            curr_composition = composition['composition']
-            if 'basic/temperature/temperature|magnitude' in curr_composition:
-                temperature = curr_composition['basic/temperature/temperature|magnitude']
-                time = curr_composition['basic/temperature/time']
+            record = global_basic_codec.fromFlat(composition)
+            if record.temperature != None:
                 temperatures.append({
-                    'temperature': temperature,
-                    'time': time
+                    'temperature': record.temperature,
+                    'time': record.time
                 })
 
     temperatures.sort(key=lambda x: x['time'])
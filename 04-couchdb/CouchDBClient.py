@@ -23,20 +23,46 @@
 # SOFTWARE.
 
 
+import codecs
+import collections
+import concurrent.futures
 import json
+import re
 import requests
 import requests.auth
+import threading
 import urllib.parse
 
+
+# Regular expression locating the beginning of the array of rows in
+# the answer to a query against a view or against "_all_docs"
+_ROWS_START = re.compile(r'"rows"\s*:\s*\[')
+
+# HTTP status code returned by CouchDB if the revision of a document
+# does not correspond to its latest revision (MVCC conflict)
+_HTTP_CONFLICT = 409
+
+# Maximum number of documents in one request to "_purge" (this is the
+# default value of "max_document_id_number" in CouchDB 3)
+_MAX_PURGED_DOCUMENTS = 100
+
 # Class that represents a connection to some CouchDB server
 class CouchDBClient:
 
     # Constructor for the connection: An URL, an username, and a
     # password are expected.
+    #
+    # The client remembers the latest known revisions of up to
+    # "revisionCacheSize" documents (LRU policy), which avoids asking
+    # CouchDB for the revision before replacing or deleting a
+    # document. If the cached revision is outdated, the write is
+    # retried at most "maxRetries" times.
     def __init__(self,
                  url = 'http://localhost:5984',
                  username = 'admin',
-                 password = 'password'):
+                 password = 'password',
+                 revisionCacheSize = 1000,
+                 maxRetries = 3):
         # Make sure that the URL does not end with a slash
         if url.endswith('/'):
             self.url = url[0 : len(url) - 1]
@@ -45,6 +71,10 @@ class CouchDBClient:
 
         self.username = username
         self.password = password
+        self.revisionCacheSize = revisionCacheSize
+        self.maxRetries = maxRetries
+        self._revisions = collections.OrderedDict()  # (db, key) => revision
+        self._revisionsLock = threading.Lock()
 
     def _getAuthentication(self):
         return requests.auth.HTTPBasicAuth(self.username, self.password)
@@ -58,8 +88,72 @@ class CouchDBClient:
         r.raise_for_status()
         return r.json() ['uuids'][0]
 
-    def _getDocumentRevision(self, db, key):
-        return self.getDocument(db, key) ['_rev']
+    def _cacheRevision(self, db, key, revision):
+        if self.revisionCacheSize <= 0:
+            return
+
+        with self._revisionsLock:
+            self._revisions[(db, key)] = revision
+            self._revisions.move_to_end((db, key))
+            while len(self._revisions) > self.revisionCacheSize:
+                self._revisions.popitem(last = False)
+
+    def _forgetRevision(self, db, key):
+        with self._revisionsLock:
+            self._revisions.pop((db, key), None)
+
+    def _forgetDatabaseRevisions(self, db):
+        with self._revisionsLock:
+            for item in list(self._revisions.keys()):
+                if item[0] == db:
+                    del self._revisions[item]
+
+    # Internal method to get the latest revision of a document. The
+    # revision is read from the cache if available. Otherwise, only
+    # the "ETag" header is retrieved using a HEAD request, instead of
+    # downloading the full document.
+    def _getDocumentRevision(self, db, key, useCache = True):
+        if useCache:
+            with self._revisionsLock:
+                revision = self._revisions.get((db, key))
+                if revision != None:
+                    self._revisions.move_to_end((db, key))
+                    return revision
+
+        r = requests.head('%s/%s/%s' % (self.url, db, key),
+                          auth = self._getAuthentication())
+        r.raise_for_status()
+
+        etag = r.headers.get('ETag')
+        if etag == None or len(etag) == 0:
+            raise Exception('No ETag')
+
+        revision = etag.strip('"')
+        self._cacheRevision(db, key, revision)
+        return revision
+
+    # Internal method to execute a write request (PUT or DELETE) that
+    # requires the revision of a document. If "revision" is "None",
+    # the latest revision is used, and the request is retried if a
+    # conflict occurs because of an outdated revision.
+    def _writeWithRevision(self, db, key, revision, write):
+        if revision != None:
+            r = write(revision)
+            r.raise_for_status()
+            return r
+
+        useCache = True
+        for retry in range(self.maxRetries + 1):
+            r = write(self._getDocumentRevision(db, key, useCache))
+            if r.status_code != _HTTP_CONFLICT:
+                break
+
+            # The revision is outdated, ask CouchDB for the latest one
+            self._forgetRevision(db, key)
+            useCache = False
+
+        r.raise_for_status()
+        return r
 
 
     # Return the list of all the databases (i.e., all the collections
@@ -87,6 +181,7 @@ class CouchDBClient:
         r = requests.delete('%s/%s' % (self.url, name),
                             auth = self._getAuthentication())
         r.raise_for_status()
+        self._forgetDatabaseRevisions(name)
 
 
     # Add a new JSON document with content "doc" to the database whose
@@ -107,6 +202,7 @@ class CouchDBClient:
                          data = json.dumps(doc),
                          auth = self._getAuthentication())
         r.raise_for_status()
+        self._cacheRevision(db, key, r.json() ['rev'])
 
         return key
 
@@ -126,13 +222,120 @@ class CouchDBClient:
         return result
 
 
+    # Internal method to iterate over the rows of the answer "r" to a
+    # query against a view or against "_all_docs", without loading
+    # the full answer in memory. The request must have been done with
+    # the "stream = True" option of the "requests" library. The rows
+    # are parsed one by one, as soon as they are fully received.
+    def _streamRows(self, r, chunkSize = 65536):
+        decoder = json.JSONDecoder()
+        textDecoder = codecs.getincrementaldecoder('utf-8')()
+        buffer = ''
+        started = False
+
+        try:
+            for chunk in r.iter_content(chunk_size = chunkSize):
+                buffer += textDecoder.decode(chunk)
+
+                if not started:
+                    m = _ROWS_START.search(buffer)
+                    if m == None:
+                        continue  # Wait for more data
+                    buffer = buffer[m.end() :]
+                    started = True
+
+                position = 0
+                while True:
+                    # Skip the separators between two rows
+                    while (position < len(buffer) and
+                           (buffer[position].isspace() or buffer[position] == ',')):
+                        position += 1
+
+                    if position == len(buffer):
+                        break  # Wait for more data
+                    elif buffer[position] == ']':
+                        return  # End of the array of rows
+
+                    try:
+                        row, position = decoder.raw_decode(buffer, position)
+                    except ValueError:
+                        break  # The row is incomplete, wait for more data
+
+                    yield row
+
+                buffer = buffer[position :]
+
+            if not started:
+                raise Exception('No row in the answer of CouchDB')
+            else:
+                raise Exception('Truncated answer from CouchDB')
+        finally:
+            r.close()
+
+
+    # Return the content of the JSON documents that are part of the
+    # database "db". This is a generator that yields the documents one
+    # by one, as they are received from CouchDB, which avoids one
+    # request per document as with "getDocument()". The content of all
+    # the documents is retrieved using one single request to
+    # "_all_docs".
+    #
+    # By default, all the documents except the design documents are
+    # returned. If "keys" is provided, only the documents whose
+    # identifiers are listed in "keys" are returned (in the same
+    # order), ignoring the missing or deleted documents. If
+    # "includeDocs" is "False", only the "_id" and "_rev" fields of
+    # the documents are returned.
+    def getDocuments(self, db, keys = None, includeDocs = True):
+        url = '%s/%s/_all_docs' % (self.url, db)
+        params = self._getViewParameters(includeDocs = includeDocs)
+
+        if keys == None:
+            r = requests.get(url,
+                             params = params,
+                             stream = True,
+                             auth = self._getAuthentication())
+        else:
+            r = requests.post(url,
+                              params = params,
+                              data = json.dumps({
+                                  'keys' : list(keys),
+                              }),
+                              headers = {
+                                  'Content-Type' : 'application/json',
+                              },
+                              stream = True,
+                              auth = self._getAuthentication())
+
+        r.raise_for_status()
+
+        for row in self._streamRows(r):
+            if ('error' in row or             # Unknown document
+                row['value'].get('deleted')):  # Deleted document
+                continue
+
+            if keys == None and row['id'].startswith('_design/'):
+                continue  # Ignore design documents
+
+            if includeDocs:
+                yield row['doc']
+            else:
+                yield {
+                    '_id' : row['id'],
+                    '_rev' : row['value']['rev'],
+                }
+
+
     # Return the content of the JSON document associated with
     # identifier "key" that is part of the database "db".
     def getDocument(self, db, key):
         r = requests.get('%s/%s/%s' % (self.url, db, key),
                          auth = self._getAuthentication())
         r.raise_for_status()
-        return r.json()
+
+        doc = r.json()
+        self._cacheRevision(db, key, doc['_rev'])
+        return doc
 
 
     # Replace the content of the JSON document associated with
@@ -145,13 +348,14 @@ class CouchDBClient:
     # resolve conflicts by yourself, the argument "revision" must
     # contain the revision of the document that you intend to replace.
     def replaceDocument(self, db, key, doc, revision = None):
-        if revision == None:
-            revision = self._getDocumentRevision(db, key)
-        
-        r = requests.put('%s/%s/%s?rev=%s' % (self.url, db, key, urllib.parse.quote(revision)),
-                         data = json.dumps(doc),
-                         auth = self._getAuthentication())
-        r.raise_for_status()
+        body = json.dumps(doc)
+
+        r = self._writeWithRevision(db, key, revision, lambda rev: requests.put(
+            '%s/%s/%s?rev=%s' % (self.url, db, key, urllib.parse.quote(rev)),
+            data = body,
+            auth = self._getAuthentication()))
+
+        self._cacheRevision(db, key, r.json() ['rev'])
 
 
     # Delete the document associated with identifier "key" that is
@@ -163,12 +367,12 @@ class CouchDBClient:
     # must contain the revision of the document that you intend to
     # remove.
     def deleteDocument(self, db, key, revision = None):
-        if revision == None:
-            revision = self._getDocumentRevision(db, key)
-        
-        r = requests.delete('%s/%s/%s?rev=%s' % (self.url, db, key, urllib.parse.quote(revision)),
-                            auth = self._getAuthentication())
-        r.raise_for_status()
+        try:
+            self._writeWithRevision(db, key, revision, lambda rev: requests.delete(
+                '%s/%s/%s?rev=%s' % (self.url, db, key, urllib.parse.quote(rev)),
+                auth = self._getAuthentication()))
+        finally:
+            self._forgetRevision(db, key)
 
 
     # Install a view called "viewName" in database "db", inside the
@@ -214,25 +418,557 @@ class CouchDBClient:
         r.raise_for_status()
         
 
+    # Internal method to convert the options of a query against a
+    # view (or against "_all_docs") into the GET arguments expected by
+    # CouchDB. Keys are arbitrary JSON values, so they are encoded as
+    # JSON (a string key "abc" becomes "\"abc\"").
+    def _getViewParameters(self, key = None, startKey = None, endKey = None,
+                           startKeyDocId = None, endKeyDocId = None,
+                           inclusiveEnd = None, limit = None, skip = None,
+                           descending = False, includeDocs = False,
+                           reduce = None, group = None, groupLevel = None,
+                           stale = None, update = None):
+        params = {}
+
+        if key != None:
+            params['key'] = json.dumps(key)
+        if startKey != None:
+            params['startkey'] = json.dumps(startKey)
+        if endKey != None:
+            params['endkey'] = json.dumps(endKey)
+        if startKeyDocId != None:
+            params['startkey_docid'] = startKeyDocId
+        if endKeyDocId != None:
+            params['endkey_docid'] = endKeyDocId
+        if inclusiveEnd != None:
+            params['inclusive_end'] = json.dumps(inclusiveEnd)
+        if limit != None:
+            params['limit'] = int(limit)
+        if skip != None:
+            params['skip'] = int(skip)
+        if descending:
+            params['descending'] = 'true'
+        if includeDocs:
+            params['include_docs'] = 'true'
+        if reduce != None:
+            params['reduce'] = json.dumps(reduce)
+        if group != None:
+            params['group'] = json.dumps(group)
+        if groupLevel != None:
+            params['group_level'] = int(groupLevel)
+        if stale != None:
+            # Either "ok" or "update_after"
+            params['stale'] = stale
+        if update != None:
+            # Either "true", "false", or "lazy"
+            if isinstance(update, bool):
+                params['update'] = json.dumps(update)
+            else:
+                params['update'] = update
+
+        return params
+
+
+    # Internal method to query the rows of a view (or of "_all_docs")
+    # located at "url". If "keys" is provided, the query is done using
+    # a POST request, which allows to provide an arbitrary number of
+    # keys without hitting the limits on the length of URLs.
+    def _queryRows(self, url, params, keys = None):
+        if keys == None:
+            r = requests.get(url,
+                             params = params,
+                             auth = self._getAuthentication())
+        else:
+            r = requests.post(url,
+                              params = params,
+                              data = json.dumps({
+                                  'keys' : list(keys),
+                              }),
+                              headers = {
+                                  'Content-Type' : 'application/json',
+                              },
+                              auth = self._getAuthentication())
+
+        r.raise_for_status()
+        return r.json() ['rows']
+
+
     # Execute the view "viewName", installed inside the design
-    # document "designName" of the database "db".
+    # document "designName" of the database "db", and return the
+    # matching rows.
     #
     # If provided, the argument "key" restricts the view to the JSON
-    # documents in the view that are mapped to the provided key.
-    def executeView(self, db, designName, viewName, key = None):
-        params = {}
+    # documents in the view that are mapped to the provided key. Keys
+    # can be any JSON value (strings, numbers, arrays...). The other
+    # arguments map to the options of the CouchDB view API:
+    #
+    # - "keys" is a list of keys to look for (sent using POST),
+    # - "startKey"/"endKey" restrict the view to a range of keys, and
+    #   "startKeyDocId"/"endKeyDocId" disambiguate identical keys,
+    # - "limit", "skip", and "descending" control paging and order,
+    # - "includeDocs" adds the full JSON document to each row (field
+    #   "doc"),
+    # - "reduce", "group", and "groupLevel" control the reduce()
+    #   function of the view, if any,
+    # - "stale" ("ok" or "update_after") and "update" ("true",
+    #   "false", or "lazy") control whether the index is updated
+    #   before answering.
+    def executeView(self, db, designName, viewName, key = None,
+                    keys = None, startKey = None, endKey = None,
+                    startKeyDocId = None, endKeyDocId = None,
+                    inclusiveEnd = None, limit = None, skip = None,
+                    descending = False, includeDocs = False,
+                    reduce = None, group = None, groupLevel = None,
+                    stale = None, update = None):
+        params = self._getViewParameters(key = key,
+                                         startKey = startKey,
+                                         endKey = endKey,
+                                         startKeyDocId = startKeyDocId,
+                                         endKeyDocId = endKeyDocId,
+                                         inclusiveEnd = inclusiveEnd,
+                                         limit = limit,
+                                         skip = skip,
+                                         descending = descending,
+                                         includeDocs = includeDocs,
+                                         reduce = reduce,
+                                         group = group,
+                                         groupLevel = groupLevel,
+                                         stale = stale,
+                                         update = update)
+
+        return self._queryRows('%s/%s/_design/%s/_view/%s' % (self.url, db, designName, viewName),
+                               params, keys)
+
+
+    # Iterate over the rows of the view "viewName", installed inside
+    # the design document "designName" of the database "db". Contrarily
+    # to "executeView()", the rows are retrieved by pages of
+    # "pageSize" rows, which keeps the memory usage bounded even for
+    # very large views. Paging is implemented by continuation on
+    # ("startkey", "startkey_docid"), which is much faster than using
+    # "skip" on large views. This only works on the map() part of a
+    # view (i.e., "reduce" is always disabled).
+    def iterateView(self, db, designName, viewName, pageSize = 1000,
+                    key = None, startKey = None, endKey = None,
+                    inclusiveEnd = None, descending = False,
+                    includeDocs = False, stale = None, update = None):
+        if pageSize <= 0:
+            raise Exception('The page size must be positive')
+
         if key != None:
-            params['key'] = '"%s"' % key
+            # "key" is a shortcut for "startkey" == "endkey"
+            startKey = key
+            endKey = key
+
+        url = '%s/%s/_design/%s/_view/%s' % (self.url, db, designName, viewName)
+        params = self._getViewParameters(startKey = startKey,
+                                         endKey = endKey,
+                                         inclusiveEnd = inclusiveEnd,
+                                         limit = pageSize + 1,  # One more row, to know where the next page starts
+                                         descending = descending,
+                                         includeDocs = includeDocs,
+                                         reduce = False,
+                                         stale = stale,
+                                         update = update)
+
+        while True:
+            rows = self._queryRows(url, params)
+
+            for row in rows[0 : pageSize]:
+                yield row
+
+            if len(rows) <= pageSize:
+                return  # We are done
+            else:
+                # The key is set explicitly, as it might be "null"
+                params['startkey'] = json.dumps(rows[pageSize]['key'])
+                params['startkey_docid'] = rows[pageSize]['id']
+
+
+    # Internal method to create the body of a Mango query
+    def _getMangoQuery(self, selector, fields, sort, limit, skip, bookmark, useIndex):
+        query = {
+            'selector' : selector,
+        }
+
+        if fields != None:
+            query['fields'] = fields
+        if sort != None:
+            query['sort'] = sort
+        if limit != None:
+            query['limit'] = int(limit)
+        if skip != None:
+            query['skip'] = int(skip)
+        if bookmark != None:
+            query['bookmark'] = bookmark
+        if useIndex != None:
+            query['use_index'] = useIndex
+
+        return query
+
+
+    # Internal method to POST a JSON body to the database "db" of the
+    # CouchDB server
+    def _postJson(self, db, path, body):
+        r = requests.post('%s/%s/%s' % (self.url, db, path),
+                          data = json.dumps(body),
+                          headers = {
+                              'Content-Type' : 'application/json',
+                          },
+                          auth = self._getAuthentication())
+        r.raise_for_status()
+        return r.json()
+
+
+    # Execute a Mango query (i.e., a declarative query) against the
+    # database "db", and return a pair containing the matching JSON
+    # documents and the bookmark to be provided to get the next page
+    # of results. The "selector" argument is a JSON object, for
+    # instance "{ 'type' : 'temperature', 'patient_id' : 'xxx' }".
+    # The optional arguments are:
+    #
+    # - "fields" is the list of the fields to be returned,
+    # - "sort" is the sort specification, for instance
+    #   "[ { 'time' : 'asc' } ]" (this requires a suitable index),
+    # - "limit" is the maximum number of documents to be returned
+    #   (note that CouchDB uses a limit of 25 by default),
+    # - "bookmark" is the bookmark returned by a previous call,
+    # - "useIndex" forces the use of a specific index.
+    def find(self, db, selector, fields = None, sort = None, limit = None,
+             bookmark = None, skip = None, useIndex = None):
+        answer = self._postJson(db, '_find', self._getMangoQuery(
+            selector, fields, sort, limit, skip, bookmark, useIndex))
+        return (answer['docs'], answer.get('bookmark'))
+
+
+    # Iterate over all the JSON documents of the database "db" that
+    # match the Mango query defined by "selector". This is a generator
+    # that retrieves the documents by pages of "pageSize" items,
+    # using bookmarks to continue from one page to the next.
+    def iterateFind(self, db, selector, fields = None, sort = None,
+                    pageSize = 1000, useIndex = None):
+        if pageSize <= 0:
+            raise Exception('The page size must be positive')
+
+        bookmark = None
+
+        while True:
+            (docs, bookmark) = self.find(db, selector, fields = fields, sort = sort,
+                                         limit = pageSize, bookmark = bookmark,
+                                         useIndex = useIndex)
+
+            for doc in docs:
+                yield doc
+
+            if len(docs) < pageSize or bookmark == None:
+                return  # We are done
+
+
+    # Explain how CouchDB would execute a Mango query, without
+    # executing it. The returned JSON object notably contains the
+    # "index" field, which tells which index would be used. If the
+    # name of this index is "_all_docs", the query would scan all the
+    # documents of the database, which indicates a missing index.
+    def explain(self, db, selector, fields = None, sort = None, limit = None,
+                skip = None, useIndex = None):
+        return self._postJson(db, '_explain', self._getMangoQuery(
+            selector, fields, sort, limit, skip, None, useIndex))
+
+
+    # Create a Mango index over the given list of "fields" of the
+    # documents in database "db", for instance "[ 'type',
+    # 'patient_id', 'time' ]". The index is stored in the design
+    # document "designName" (automatically generated if "None"). If
+    # "partialFilter" is provided, only the documents that match this
+    # selector are indexed. The method returns the name of the index.
+    # If an identical index already exists, it is left unchanged.
+    def createIndex(self, db, fields, name = None, designName = None, partialFilter = None):
+        index = {
+            'fields' : fields,
+        }
 
-        r = requests.get('%s/%s/_design/%s/_view/%s' % (self.url, db, designName, viewName),
+        if partialFilter != None:
+            index['partial_filter_selector'] = partialFilter
+
+        body = {
+            'index' : index,
+            'type' : 'json',
+        }
+
+        if name != None:
+            body['name'] = name
+        if designName != None:
+            body['ddoc'] = designName
+
+        return self._postJson(db, '_index', body) ['name']
+
+
+    # List the Mango indexes that are defined in the database "db".
+    def listIndexes(self, db):
+        r = requests.get('%s/%s/_index' % (self.url, db),
+                         auth = self._getAuthentication())
+        r.raise_for_status()
+        return r.json() ['indexes']
+
+
+    # Delete the Mango index called "name" that is stored in the
+    # design document "designName" of the database "db".
+    def deleteIndex(self, db, designName, name):
+        r = requests.delete('%s/%s/_index/%s/json/%s' % (self.url, db, designName, name),
+                            auth = self._getAuthentication())
+        r.raise_for_status()
+
+
+    # Return the list of the changes that occurred in the database
+    # "db" after the sequence "since" (from the beginning if "None",
+    # or only the future changes if "now"), together with the sequence
+    # of the last change. This last sequence must be provided as the
+    # "since" argument of the next call to get the subsequent changes
+    # (it can notably be stored using "saveCheckpoint()").
+    #
+    # Each change is a JSON object containing the fields "id" (the
+    # identifier of the document), "seq" (the sequence of the change),
+    # "changes" (the list of the new revisions), and "deleted" if the
+    # document was removed. If "includeDocs" is "True", the field
+    # "doc" contains the content of the document. If "allLeaves" is
+    # "True", "changes" lists all the leaf revisions of the document
+    # (including the conflicting and the deleted ones), instead of
+    # only its winning revision.
+    #
+    # If "longpoll" is "True" and there is no change after "since",
+    # CouchDB waits for at most "timeout" milliseconds until a change
+    # occurs before answering.
+    def getChanges(self, db, since = None, limit = None, includeDocs = False,
+                   longpoll = False, timeout = 60000, allLeaves = False):
+        params = {}
+
+        if since != None:
+            params['since'] = since
+        if limit != None:
+            params['limit'] = int(limit)
+        if includeDocs:
+            params['include_docs'] = 'true'
+        if allLeaves:
+            params['style'] = 'all_docs'
+
+        if longpoll:
+            params['feed'] = 'longpoll'
+            params['timeout'] = int(timeout)
+            clientTimeout = timeout / 1000.0 + 10.0  # Give some slack to CouchDB
+        else:
+            clientTimeout = None
+
+        r = requests.get('%s/%s/_changes' % (self.url, db),
                          params = params,
+                         timeout = clientTimeout,
                          auth = self._getAuthentication())
         r.raise_for_status()
-        return r.json() ['rows']
+
+        answer = r.json()
+        return (answer['results'], answer['last_seq'])
+
+
+    # Iterate over the changes that occurred in the database "db"
+    # after the sequence "since". The changes are retrieved by batches
+    # of "batchSize" items, which keeps the memory usage bounded. If
+    # "follow" is "False", the generator stops once all the past
+    # changes have been returned. If "follow" is "True", the generator
+    # then waits for the future changes using long polling, and never
+    # stops. The "seq" field of each change can be used as a
+    # checkpoint to resume the iteration later on. The "allLeaves"
+    # argument has the same meaning as in "getChanges()".
+    def iterateChanges(self, db, since = None, includeDocs = False,
+                       batchSize = 1000, follow = False, timeout = 60000,
+                       allLeaves = False):
+        if batchSize <= 0:
+            raise Exception('The batch size must be positive')
+
+        while True:
+            (changes, since) = self.getChanges(db, since = since, limit = batchSize,
+                                               includeDocs = includeDocs,
+                                               longpoll = follow, timeout = timeout,
+                                               allLeaves = allLeaves)
+
+            for change in changes:
+                yield change
+
+            if not follow and len(changes) < batchSize:
+                return  # We are done
+
+
+    # Iterate over the changes that occur in the database "db" after
+    # the sequence "since", using a continuous feed: One single HTTP
+    # connection is kept open, and the changes are returned as soon as
+    # CouchDB reports them. CouchDB sends an empty line every
+    # "heartbeat" milliseconds to keep the connection alive. The
+    # generator never stops, unless the connection is closed.
+    def followChanges(self, db, since = 'now', includeDocs = False, heartbeat = 10000):
+        params = {
+            'feed' : 'continuous',
+            'heartbeat' : int(heartbeat),
+            'since' : since,
+        }
+
+        if includeDocs:
+            params['include_docs'] = 'true'
+
+        r = requests.get('%s/%s/_changes' % (self.url, db),
+                         params = params,
+                         stream = True,
+                         timeout = heartbeat / 1000.0 + 10.0,  # Between two heartbeats
+                         auth = self._getAuthentication())
+        r.raise_for_status()
+
+        try:
+            for line in r.iter_lines():
+                if len(line) == 0:
+                    continue  # Heartbeat
+
+                change = json.loads(line)
+                if 'last_seq' in change:
+                    return  # End of the feed
+                else:
+                    yield change
+        finally:
+            r.close()
+
+
+    # Return the sequence that was stored as the checkpoint "name" for
+    # the database "db" by "saveCheckpoint()", or "None" if no such
+    # checkpoint exists. Checkpoints are stored as local documents,
+    # which are not replicated and not reported in the changes feed.
+    def loadCheckpoint(self, db, name):
+        return self.loadCheckpointWithContent(db, name) [0]
+
+
+    # Same as "loadCheckpoint()", but return a pair (sequence,
+    # content), where "content" is the JSON value that was stored
+    # together with the sequence (or "None" if there is none).
+    def loadCheckpointWithContent(self, db, name):
+        r = requests.get('%s/%s/_local/%s' % (self.url, db, name),
+                         auth = self._getAuthentication())
+
+        if r.status_code == 404:
+            return (None, None)
+        else:
+            r.raise_for_status()
+            doc = r.json()
+            return (doc['seq'], doc.get('content'))
+
+
+    # Store the sequence "seq" of the changes feed of the database
+    # "db" as the checkpoint "name". If "content" is provided, this
+    # JSON value is stored together with the sequence.
+    def saveCheckpoint(self, db, name, seq, content = None):
+        url = '%s/%s/_local/%s' % (self.url, db, name)
+
+        r = requests.get(url, auth = self._getAuthentication())
+        if r.status_code == 404:
+            doc = {}
+        else:
+            r.raise_for_status()
+            doc = r.json()
+
+        doc['seq'] = seq
+        if content == None:
+            doc.pop('content', None)
+        else:
+            doc['content'] = content
+
+        r = requests.put(url,
+                         data = json.dumps(doc),
+                         auth = self._getAuthentication())
+        r.raise_for_status()
+
+
+    # Remove the checkpoint "name" of the database "db", if it exists.
+    def deleteCheckpoint(self, db, name):
+        url = '%s/%s/_local/%s' % (self.url, db, name)
+
+        r = requests.get(url, auth = self._getAuthentication())
+        if r.status_code == 404:
+            return
+
+        r.raise_for_status()
+        r = requests.delete(url,
+                            params = { 'rev' : r.json() ['_rev'] },
+                            auth = self._getAuthentication())
+        if r.status_code != 404:
+            r.raise_for_status()
 
 
     # Remove all the databases and all the JSON documents that are
     # currently stored inside the CouchDB server.
-    def reset(self):
-        for db in self.listDatabases():
-            self.deleteDatabase(db)
+    #
+    # The databases are processed concurrently by at most "workers"
+    # threads. If "truncate" is "True", the databases are not deleted,
+    # but emptied using "truncateDatabase()", which preserves the
+    # design documents and their view indexes.
+    def reset(self, truncate = False, workers = 8):
+        if truncate:
+            process = self.truncateDatabase
+        else:
+            process = self.deleteDatabase
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+            # Consume the results to propagate the exceptions, if any
+            list(executor.map(process, self.listDatabases()))
+
+
+    # Remove all the JSON documents of the database "db", except the
+    # design documents. Contrarily to deleting and re-creating the
+    # database, this preserves the views and their already-built
+    # indexes, which avoids a full rebuild of the views. The documents
+    # are listed by batches of "batchSize" items from the changes
+    # feed, which reports all their leaf revisions, so that the
+    # conflicting revisions are removed as well. If "purge" is "True",
+    # all the leaf revisions are purged using "_purge", so that
+    # neither the documents nor their tombstones are left in the
+    # database and in its changes feed. Otherwise, all the leaf
+    # revisions are deleted using "_bulk_docs". Note that if more than
+    # "purged_infos_limit" (1000 by default) documents are purged,
+    # CouchDB might decide to rebuild the view indexes anyway.
+    def truncateDatabase(self, db, batchSize = 1000, purge = True):
+        batch = []
+
+        for change in self.iterateChanges(db, batchSize = batchSize, allLeaves = True):
+            if change['id'].startswith('_design/'):
+                continue  # Keep the design documents
+            elif change.get('deleted') and not purge:
+                continue  # Already deleted (this includes the deletions by this loop)
+
+            batch.append((change['id'], list(map(lambda x: x['rev'], change['changes']))))
+            if len(batch) == batchSize:
+                self._deleteDocuments(db, batch, purge)
+                batch = []
+
+        if len(batch) > 0:
+            self._deleteDocuments(db, batch, purge)
+
+        self._forgetDatabaseRevisions(db)
+
+
+    # Internal method to purge, or to delete, a list of documents,
+    # each of them being given as a pair (identifier, list of its leaf
+    # revisions).
+    def _deleteDocuments(self, db, docs, purge):
+        if purge:
+            # Purging all the leaf revisions removes the whole
+            # revision tree of the document
+            for i in range(0, len(docs), _MAX_PURGED_DOCUMENTS):
+                self._postJson(db, '_purge', dict(docs[i : i + _MAX_PURGED_DOCUMENTS]))
+        else:
+            # Deleting the conflicting revisions together with the
+            # winning revision leaves only tombstones
+            deletions = []
+            for (key, revisions) in docs:
+                for revision in revisions:
+                    deletions.append({
+                        '_id' : key,
+                        '_rev' : revision,
+                        '_deleted' : True,
+                    })
+
+            self._postJson(db, '_bulk_docs', {
+                'docs' : deletions,
+            })
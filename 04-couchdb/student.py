@@ -21,15 +21,225 @@
 
 
 import CouchDBClient
+import bisect
 import datetime
 import flask
 import json
+import logging
+import threading
+import time
 
 app = flask.Flask(__name__)
+_logger = logging.getLogger(__name__)
 
 
 global_credentials = None
 
+# The CouchDB client is shared by all the requests, so that its cache
+# of the revisions of the documents is effective
+global_client = None
+
+# Name of the local document that stores the checkpoint of the index
+INDEX_CHECKPOINT = 'materialized-index'
+
+# In-memory index over the patients and the temperatures that are
+# stored in one CouchDB collection. The index is kept up-to-date
+# incrementally by following the changes feed of CouchDB in a
+# background thread, which allows "/patients" and "/temperatures" to
+# be answered without any request to CouchDB. The documents that are
+# written by this application are also applied immediately using
+# "apply()", so that they are visible to the subsequent reads.
+#
+# The content of the index is periodically saved, together with the
+# last sequence of the changes feed, as the local document
+# "checkpoint" of the collection. After a restart, the index is
+# restored from this checkpoint and only follows the changes that
+# occurred since then, instead of reading the whole changes feed.
+class MaterializedIndex:
+
+    def __init__(self, client, db, batchSize = 1000, timeout = 10000,
+                 checkpoint = INDEX_CHECKPOINT, checkpointInterval = 10):
+        self._client = client
+        self._db = db
+        self._batchSize = batchSize
+        self._timeout = timeout
+        self._checkpoint = checkpoint
+        self._checkpointInterval = checkpointInterval
+        self._checkpointLock = threading.Lock()
+        self._checkpointSeq = None
+        self._checkpointTime = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lastSeq = None
+        self._patients = {}      # Patient ID => name
+        self._series = {}        # Patient ID => sorted list of (time, document ID, temperature)
+        self._documents = {}     # Document ID => entry in "_patients" or "_series"
+
+    # Internal method to remove a document from the index. The lock
+    # must be held by the caller.
+    def _remove(self, key):
+        entry = self._documents.pop(key, None)
+        if entry == None:
+            return
+        elif entry[0] == 'patient':
+            self._patients.pop(key, None)
+        else:
+            series = self._series.get(entry[1], [])
+            i = bisect.bisect_left(series, entry[2])
+            if i < len(series) and series[i] == entry[2]:
+                del series[i]
+
+    # Internal method to add or update a document in the index. The
+    # lock must be held by the caller.
+    def _apply(self, doc):
+        key = doc['_id']
+        self._remove(key)
+
+        if doc.get('_deleted'):
+            return
+        elif doc.get('type') == 'patient':
+            self._patients[key] = doc['name']
+            self._documents[key] = ('patient', )
+        elif doc.get('type') == 'temperature':
+            item = (doc['time'], key, doc['temperature'])
+            bisect.insort(self._series.setdefault(doc['patient_id'], []), item)
+            self._documents[key] = ('temperature', doc['patient_id'], item)
+
+    # Add or update one document (that must contain its "_id" field)
+    # in the index.
+    def apply(self, doc):
+        with self._lock:
+            self._apply(doc)
+
+    # Apply all the changes that occurred in CouchDB since the last
+    # call. If "longpoll" is "True", wait for the next change if there
+    # is none.
+    def refresh(self, longpoll = False):
+        while True:
+            (changes, lastSeq) = self._client.getChanges(self._db,
+                                                         since = self._lastSeq,
+                                                         limit = self._batchSize,
+                                                         includeDocs = True,
+                                                         longpoll = longpoll,
+                                                         timeout = self._timeout)
+
+            with self._lock:
+                for change in changes:
+                    try:
+                        if change.get('deleted'):
+                            self._remove(change['id'])
+                        elif 'doc' in change:
+                            self._apply(change['doc'])
+                    except Exception as e:
+                        # Skip a malformed document (e.g., a patient
+                        # without a name), so that the checkpoint
+                        # still moves forward
+                        _logger.warning('Ignoring change to document %s: %s' % (change.get('id'), repr(e)))
+                self._lastSeq = lastSeq
+
+            if len(changes) < self._batchSize:
+                return
+
+    # Internal method to export the content of the index as a JSON
+    # value, together with the sequence it corresponds to.
+    def _export(self):
+        with self._lock:
+            temperatures = []
+            for (patientId, series) in self._series.items():
+                for (timestamp, key, temperature) in series:
+                    temperatures.append([ key, patientId, timestamp, temperature ])
+
+            return (self._lastSeq, {
+                'patients' : self._patients.copy(),
+                'temperatures' : temperatures,
+            })
+
+    # Internal method to restore the content of the index from a JSON
+    # value that was created by "_export()".
+    def _import(self, seq, content):
+        with self._lock:
+            for (key, name) in content['patients'].items():
+                self._apply({ '_id' : key, 'type' : 'patient', 'name' : name })
+            for (key, patientId, timestamp, temperature) in content['temperatures']:
+                self._apply({
+                    '_id' : key,
+                    'type' : 'temperature',
+                    'patient_id' : patientId,
+                    'time' : timestamp,
+                    'temperature' : temperature,
+                })
+            self._lastSeq = seq
+
+    # Save the content of the index into the checkpoint, if the
+    # sequence has changed since the last save. Unless "force" is
+    # "True", the checkpoint is saved at most once every
+    # "checkpointInterval" seconds.
+    def saveCheckpoint(self, force = False):
+        with self._checkpointLock:
+            if (not force and
+                time.time() < self._checkpointTime + self._checkpointInterval):
+                return
+
+            (seq, content) = self._export()
+            if seq == None or seq == self._checkpointSeq:
+                return
+
+            self._client.saveCheckpoint(self._db, self._checkpoint, seq, content)
+            self._checkpointSeq = seq
+            self._checkpointTime = time.time()
+
+    def _follow(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh(longpoll = True)
+                if not self._stopped.is_set():
+                    self.saveCheckpoint()
+            except Exception:
+                # CouchDB is not reachable, or the collection was deleted
+                self._stopped.wait(1)
+
+    # Restore the index from its checkpoint (if any), load the changes
+    # that occurred since then, then start following the changes in a
+    # background thread.
+    def start(self):
+        (seq, content) = self._client.loadCheckpointWithContent(self._db, self._checkpoint)
+        if seq != None and content != None:
+            self._import(seq, content)
+            self._checkpointSeq = seq
+
+        self.refresh()
+        self.saveCheckpoint(force = True)
+
+        self._thread = threading.Thread(target = self._follow, daemon = True)
+        self._thread.start()
+
+    # Stop following the changes, and save the checkpoint. The
+    # background thread exits after its pending long-polling request,
+    # but does not save the checkpoint anymore.
+    def stop(self, saveCheckpoint = True):
+        self._stopped.set()
+        if saveCheckpoint:
+            self.saveCheckpoint(force = True)
+        else:
+            # Wait for a save that could be in progress
+            with self._checkpointLock:
+                pass
+
+    # Return the list of the patients, as pairs (ID, name).
+    def listPatients(self):
+        with self._lock:
+            return list(self._patients.items())
+
+    # Return the temperatures of one patient, as pairs (time,
+    # temperature) sorted by increasing time.
+    def listTemperatures(self, patient_id):
+        with self._lock:
+            return list(map(lambda x: (x[0], x[2]), self._series.get(patient_id, [])))
+
+
+global_index = None
+
 @app.route('/')
 def redirection():
     return flask.redirect('index.html', code = 302)
@@ -83,17 +293,31 @@ def app_initialize(credentials):
     #   is not mandatory, but using views will improve performance and
     #   atomicity, contrarily to explicit loops over documents).
 
-    global global_credentials
+    global global_credentials, global_client
     global_credentials = credentials
 
     client = CouchDBClient.CouchDBClient(credentials['url'], credentials['username'], credentials['password'])
+    global_client = client
 
     db_name = credentials['couchdb-collection']
 
+    global global_index
+    if global_index != None:
+        # The collection is emptied below, so its checkpoint is useless
+        global_index.stop(saveCheckpoint = False)
+
+    # Emptying an existing database is faster than deleting and
+    # re-creating it, and keeps its design documents. The local
+    # documents are not removed by the truncation, so the checkpoint
+    # of the index must be explicitly forgotten.
     if db_name in client.listDatabases():
-        client.deleteDatabase(db_name)
+        client.truncateDatabase(db_name)
+        client.deleteCheckpoint(db_name, INDEX_CHECKPOINT)
+    else:
+        client.createDatabase(db_name)
 
-    client.createDatabase(db_name)
+    global_index = MaterializedIndex(client, db_name)
+    global_index.start()
 
 
 
@@ -125,12 +349,12 @@ def create_patient():
         'name': patient_name
     }
     
-    client = CouchDBClient.CouchDBClient(global_credentials['url'], global_credentials['username'], global_credentials['password'])
-    
     db_name = global_credentials['couchdb-collection']
 
-    patient_id = client.addDocument(db_name, patient_doc)
+    patient_id = global_client.addDocument(db_name, patient_doc)
 
+    patient_doc['_id'] = patient_id
+    global_index.apply(patient_doc)
 
     return flask.jsonify({ 'id': patient_id })
 
@@ -174,11 +398,12 @@ def record_temperature():
         "time": time
     }
 
-    client = CouchDBClient.CouchDBClient(global_credentials['url'], global_credentials['username'], global_credentials['password'])
+    temperature_id = global_client.addDocument(global_credentials['couchdb-collection'], temperature_doc)
 
-    patient_id = client.addDocument(global_credentials['couchdb-collection'], temperature_doc)
+    temperature_doc['_id'] = temperature_id
+    global_index.apply(temperature_doc)
 
-    return flask.jsonify({ 'id': patient_id })
+    return flask.jsonify({ 'id': temperature_id })
 
 
 @app.route('/patients', methods = [ 'GET' ])
@@ -200,18 +425,11 @@ def list_patients():
     # Hint: Try creating a CouchDB view to filter the stored JSON
     # documents whose "type" field is "patient".
 
-    
-    client = CouchDBClient.CouchDBClient(global_credentials['url'], global_credentials['username'], global_credentials['password'])
-    db_name = global_credentials['couchdb-collection']
-
-    patients = client.listDocuments(db_name)
     result = []
 
-    for patient_id in patients:
-        patient = client.getDocument(db_name, patient_id)
-        if patient['type'] == 'patient':
-            result.append({ 'id': patient_id, 'name': patient['name'] })
-    
+    for (patient_id, name) in global_index.listPatients():
+        result.append({ 'id': patient_id, 'name': name })
+
     return flask.jsonify(result)
 
 
@@ -243,18 +461,11 @@ def list_temperatures():
     if patient_id is None:
         return flask.Response('{"error": "Missing patient_id, for listing temperatures"}\n', 400)
 
-    client = CouchDBClient.CouchDBClient(global_credentials['url'], global_credentials['username'], global_credentials['password'])
-    db_name = global_credentials['couchdb-collection']
-    
-    temperatures = client.listDocuments(db_name)
     result = []
 
-    for temperature_id in temperatures:
-        temperature = client.getDocument(db_name, temperature_id)
-        if temperature['type'] == 'temperature' and temperature['patient_id'] == patient_id:
-            result.append({ 'time': temperature['time'], 'temperature': temperature['temperature'] })
+    for (time, temperature) in global_index.listTemperatures(patient_id):
+        result.append({ 'time': time, 'temperature': temperature })
 
-    result = sorted(result, key=lambda x: x['time'])
     return flask.jsonify(result)
     
 
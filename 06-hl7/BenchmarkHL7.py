@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2025, Sebastien Jodogne, ICTEAM UCLouvain, Belgium
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import HL7Toolbox
+
+import argparse
+import threading
+import time
+
+parser = argparse.ArgumentParser(description = 'Compare the lazy HL7 parser with python-hl7')
+
+parser.add_argument('--observations',
+                    type = int,
+                    default = 1000,
+                    help = 'Number of OBX segments in the generated ORU^R01 message')
+parser.add_argument('--repeat',
+                    type = int,
+                    default = 20,
+                    help = 'Number of times each message is parsed')
+parser.add_argument('--acks',
+                    type = int,
+                    default = 100000,
+                    help = 'Number of acknowledgments that are generated')
+parser.add_argument('--threads',
+                    type = int,
+                    default = 4,
+                    help = 'Number of threads generating acknowledgments concurrently')
+
+args = parser.parse_args()
+
+
+# Generate a large ORU^R01 message, starting from the sample message
+# and repeating its OBX segments
+with open('resources/RegisterVitals.hl7', 'rb') as f:
+    segments = f.read().replace(b'\r\n', b'\n').replace(b'\r', b'\n').strip().split(b'\n')
+
+header = [ x for x in segments if not x.startswith(b'OBX|') ]
+observations = [ x for x in segments if x.startswith(b'OBX|') ]
+
+data = b'\r'.join(header + [ observations[i % len(observations)] for i in range(args.observations) ]) + b'\r'
+
+
+# Access the same fields as the "/hl7" route of "student.py"
+def access_fields(msg):
+    msh = msg.segment('MSH')
+    str(msh[9][0][0][0])
+    str(msh[10][0])
+
+    pid = msg.segment('PID')
+    str(pid[3][0][0][0])
+    str(pid[5][0][0][0])
+    str(pid[8][0])
+
+    obr = msg.segment('OBR')
+    str(obr[4][0])
+    str(obr[7][0])
+
+    for obx in msg.segments('OBX'):
+        str(obx[2][0])
+        str(obx[3][0][0][0])
+        str(obx[5][0])
+
+
+def benchmark(lazy):
+    start = time.perf_counter()
+    for i in range(args.repeat):
+        access_fields(HL7Toolbox.parse_message(data, lazy = lazy))
+    return (time.perf_counter() - start) / args.repeat
+
+
+print('Message with %d OBX segments (%d bytes)' % (args.observations, len(data)))
+
+reference = benchmark(False)
+print('python-hl7:  %.2f ms per message' % (reference * 1000.0))
+
+lazy = benchmark(True)
+print('Lazy parser: %.2f ms per message' % (lazy * 1000.0))
+
+print('Speedup: %.1fx' % (reference / lazy))
+
+
+# Benchmark the generation of acknowledgments, from one single thread
+# and from several concurrent threads
+msh = HL7Toolbox.parse_message(data).segment('MSH')
+
+def generate_acks(count):
+    for i in range(count):
+        HL7Toolbox.format_acknowledgment(msh, 'AE', 'Patient not found')
+
+start = time.perf_counter()
+generate_acks(args.acks)
+elapsed = time.perf_counter() - start
+print('ACK generation (1 thread): %.0f acknowledgments/s' % (args.acks / elapsed))
+
+threads = [ threading.Thread(target = generate_acks, args = (args.acks // args.threads, ))
+            for i in range(args.threads) ]
+
+start = time.perf_counter()
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+elapsed = time.perf_counter() - start
+print('ACK generation (%d threads): %.0f acknowledgments/s' % (args.threads, args.acks / elapsed))
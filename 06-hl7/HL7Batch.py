@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2025, Sebastien Jodogne, ICTEAM UCLouvain, Belgium
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import HL7Pipeline
+import HL7Toolbox
+
+import re
+
+_SEGMENT_SEPARATORS = re.compile(rb'[\r\n]+')
+
+
+# Internal function that reads the segments of a file-like object
+# (opened in binary mode) one chunk at a time, which avoids loading
+# batch files with thousands of messages in memory.
+def _iterate_segments(f, chunk_size):
+    remainder = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if len(chunk) == 0:
+            break
+
+        segments = _SEGMENT_SEPARATORS.split(remainder + chunk)
+        remainder = segments.pop()  # The last segment might be incomplete
+        for segment in segments:
+            if len(segment) > 0:
+                yield segment
+
+    if len(remainder.strip()) > 0:
+        yield remainder
+
+
+# Split a HL7 batch file into its messages, without loading the file
+# as a whole. The file-like object "f" must be opened in binary mode.
+# The generator yields tuples "(headers, message)", where "message" is
+# one HL7 message (as an array of bytes whose segments are separated
+# by '\r'), and "headers" is a dictionary that maps "FHS" and "BHS" to
+# the raw header segments of the enclosing file and batch (if any).
+# The BTS and FTS trailer segments are skipped. Files that contain
+# a single message without batch headers are also accepted.
+def iterate_batch_messages(f, chunk_size = 65536):
+    headers = {}
+    message = []
+
+    for segment in _iterate_segments(f, chunk_size):
+        segment_id = segment[0 : 3]
+
+        if segment_id in (b'FHS', b'BHS', b'BTS', b'FTS', b'MSH'):
+            if len(message) > 0:
+                yield (headers, b'\r'.join(message) + b'\r')
+                message = []
+
+            if segment_id == b'FHS' or segment_id == b'BHS':
+                headers = dict(headers)
+                headers[segment_id.decode('ascii')] = segment
+            elif segment_id == b'MSH':
+                message.append(segment)
+
+        elif len(message) > 0:
+            message.append(segment)
+
+        else:
+            raise Exception('Segment outside of a message in a HL7 batch: %s' % segment_id.decode('ascii', 'replace'))
+
+    if len(message) > 0:
+        yield (headers, b'\r'.join(message) + b'\r')
+
+
+# Internal function that generates the FHS or BHS header of a batch
+# acknowledgment, given the header of the original batch (if any). As
+# in the acknowledgment of a single message, the sending and receiving
+# applications and facilities are swapped.
+def _format_batch_header(segment_id, original, now):
+    if original == None:
+        fields = []
+    else:
+        fields = HL7Toolbox.parse_message(original)[0]
+
+    def get_field(index):
+        if index < len(fields):
+            return str(fields[index])
+        else:
+            return ''
+
+    return '|'.join([
+        segment_id,
+        get_field(2) or '^~\\&',              # FHS/BHS-2: Encoding characters
+        get_field(5),                          # FHS/BHS-3: Sending application
+        get_field(6),                          # FHS/BHS-4: Sending facility
+        get_field(3),                          # FHS/BHS-5: Receiving application
+        get_field(4),                          # FHS/BHS-6: Receiving facility
+        now,                                   # FHS/BHS-7: Creation date/time
+        '',                                    # FHS/BHS-8: Security
+        '',                                    # FHS/BHS-9: Name/ID/Type
+        'ACK',                                 # FHS/BHS-10: Comment
+        HL7Toolbox.generate_message_id(),      # FHS/BHS-11: Control ID
+        get_field(11),                         # FHS/BHS-12: Reference control ID
+    ])
+
+
+# Ingest a HL7 batch file (possibly wrapped in FHS/BHS/BTS/FTS
+# segments). Each message is passed to the "handler" callback, that
+# takes the message as an array of bytes and returns its HL7
+# acknowledgment as a string (typically
+# "student.process_hl7_message"). The messages are processed by a
+# "HL7Pipeline.PatientPipeline" with "workers" threads, which
+# guarantees that the messages about the same patient (PID-3) are
+# processed in the order of the file, whereas different patients are
+# processed in parallel. At most "max_queue_size" messages are queued
+# for each worker, which bounds the memory that is used while reading
+# the file.
+#
+# The function returns the batch acknowledgment as a string, that
+# wraps the acknowledgments of the individual messages (in the order
+# of the file) inside FHS/BHS/BTS/FTS segments. The MSA segment of
+# each acknowledgment provides the status of the corresponding
+# message.
+def ingest_batch(f, handler, workers = 8, chunk_size = 65536, max_queue_size = 100):
+    pipeline = HL7Pipeline.PatientPipeline(handler, workers = workers, max_queue_size = max_queue_size)
+
+    try:
+        headers = {}
+        results = []
+        for (headers, message) in iterate_batch_messages(f, chunk_size):
+            results.append(pipeline.submit(message))
+
+        acks = [ x.result() for x in results ]
+    finally:
+        pipeline.shutdown()
+
+    now = HL7Toolbox.format_now()
+
+    segments = [
+        _format_batch_header('FHS', headers.get('FHS'), now),
+        _format_batch_header('BHS', headers.get('BHS'), now),
+    ]
+
+    for ack in acks:
+        segments.append(ack.strip('\r\n').replace('\n', '\r'))
+
+    segments.append('BTS|%d' % len(acks))
+    segments.append('FTS|1')
+
+    return '\r'.join(segments) + '\r'
+
+
+if __name__ == '__main__':
+    import argparse
+    import student
+
+    parser = argparse.ArgumentParser(description = 'Ingest a HL7 batch file into OpenMRS')
+
+    parser.add_argument('path',
+                        help = 'Path to the HL7 batch file')
+    parser.add_argument('--output',
+                        default = None,
+                        help = 'Path where to write the batch acknowledgment (default: standard output)')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of HL7 messages that are processed concurrently')
+    parser.add_argument('--url',
+                        default = 'http://localhost:8003/openmrs/ws/rest',
+                        help = 'Address of the REST API of OpenMRS')
+    parser.add_argument('--username',
+                        default = 'admin',
+                        help = 'Username to the REST API')
+    parser.add_argument('--password',
+                        default = 'Admin123',
+                        help = 'Password to the REST API')
+    parser.add_argument('--deduplicate',
+                        action = 'store_true',
+                        help = 'Skip the messages that were already processed (same MSH-3, MSH-4, and MSH-10)')
+
+    args = parser.parse_args()
+
+    student.app_initialize({
+        'url' : args.url,
+        'username' : args.username,
+        'password' : args.password,
+    }, deduplicate = args.deduplicate)
+
+    with open(args.path, 'rb') as f:
+        ack = ingest_batch(f, student.process_hl7_message, workers = args.workers)
+
+    if args.output == None:
+        print(ack.replace('\r', '\n'))
+    else:
+        with open(args.output, 'w') as f:
+            f.write(ack)
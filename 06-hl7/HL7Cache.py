@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2025, Sebastien Jodogne, ICTEAM UCLouvain, Belgium
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import collections
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+
+# Regular expression matching the segments of a HL7 message
+_SEGMENTS = re.compile(rb'[^\r\n]+')
+
+
+# Class maintaining a local index that maps the patient identifiers
+# used in HL7 messages (PID-3, i.e., the "custom identifiers" of
+# OpenMRS) to the UUIDs of the patient and of its single visit in
+# OpenMRS. This avoids the expensive search for the patient using the
+# REST API of OpenMRS each time a HL7 message is received.
+#
+# If "path" is provided, the index is persisted into a SQLite database
+# at this location, and reloaded at construction time.
+class PatientIndex:
+
+    def __init__(self, path = None):
+        self.lock = threading.Lock()
+        self.patients = {}
+        self.db = None
+
+        if path != None:
+            self.db = sqlite3.connect(path, check_same_thread = False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS patients (custom_id TEXT PRIMARY KEY, '
+                            'patient_uuid TEXT, visit_uuid TEXT)')
+            self.db.commit()
+
+            for (custom_id, patient_uuid, visit_uuid) in self.db.execute('SELECT * FROM patients'):
+                self.patients[custom_id] = (patient_uuid, visit_uuid)
+
+
+    # Return the tuple "(patient UUID, visit UUID)" that is associated
+    # with the given patient identifier, or "None" if the patient is
+    # not indexed.
+    def get(self, custom_id):
+        with self.lock:
+            return self.patients.get(custom_id)
+
+
+    def add(self, custom_id, patient_uuid, visit_uuid):
+        with self.lock:
+            self.patients[custom_id] = (patient_uuid, visit_uuid)
+            if self.db != None:
+                self.db.execute('INSERT OR REPLACE INTO patients VALUES (?, ?, ?)',
+                                (custom_id, patient_uuid, visit_uuid))
+                self.db.commit()
+
+
+    # Remove one patient from the index, typically because it was
+    # deleted from OpenMRS, or because the indexed UUIDs are outdated.
+    def remove(self, custom_id):
+        with self.lock:
+            self.patients.pop(custom_id, None)
+            if self.db != None:
+                self.db.execute('DELETE FROM patients WHERE custom_id=?', (custom_id, ))
+                self.db.commit()
+
+
+    def clear(self):
+        with self.lock:
+            self.patients = {}
+            if self.db != None:
+                self.db.execute('DELETE FROM patients')
+                self.db.commit()
+
+
+# Class implementing a bounded cache of the acknowledgments that were
+# sent for the already-processed HL7 messages. Interface engines
+# resend a message if they do not receive its acknowledgment in time,
+# which would otherwise create duplicate patients, encounters, or
+# observations. The cache is indexed by the triple (MSH-3, MSH-4,
+# MSH-10), i.e., the sending application and facility, and the
+# message control ID. A digest of the content of the message is
+# stored next to the acknowledgment, which is only sent back if the
+# message is identical (some senders reuse their control IDs).
+#
+# The entries expire after "ttl" seconds, and at most "max_entries"
+# entries are kept (the least recently used entries being evicted
+# first). If "path" is provided, the cache is persisted into a SQLite
+# database at this location, and reloaded at construction time.
+class DeduplicationCache:
+
+    def __init__(self, path = None, ttl = 24 * 3600, max_entries = 10000):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.acks = collections.OrderedDict()  # Key => (expiration time, acknowledgment, digest)
+        self.db = None
+
+        if path != None:
+            self.db = sqlite3.connect(path, check_same_thread = False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS acks (application TEXT, facility TEXT, control_id TEXT, '
+                            'expiration REAL, ack TEXT, digest TEXT, PRIMARY KEY (application, facility, control_id))')
+
+            # Upgrade the databases created before the digests were stored
+            columns = [ row[1] for row in self.db.execute('PRAGMA table_info(acks)') ]
+            if not 'digest' in columns:
+                self.db.execute('ALTER TABLE acks ADD COLUMN digest TEXT')
+
+            self.db.execute('DELETE FROM acks WHERE expiration<?', (time.time(), ))
+            self.db.commit()
+
+            for row in self.db.execute('SELECT application, facility, control_id, expiration, ack, digest '
+                                       'FROM acks ORDER BY expiration'):
+                self.acks[(row[0], row[1], row[2])] = (row[3], row[4], row[5])
+
+            while len(self.acks) > self.max_entries:
+                self._evict()
+
+
+    # Return the deduplication key of a message, given its MSH
+    # segment. Returns "None" if the message has no control ID
+    # (MSH-10), in which case it cannot be deduplicated.
+    @staticmethod
+    def get_key(msh):
+        control_id = str(msh[10]) if len(msh) > 10 else ''
+        if control_id.strip() == '':
+            return None
+        else:
+            return (str(msh[3]), str(msh[4]), control_id)
+
+
+    # Return the digest of the content of a message (a string or an
+    # array of bytes), which ensures that a cached acknowledgment is
+    # only sent back for the very same message: Senders may reuse the
+    # same control ID (MSH-10) for different messages.
+    @staticmethod
+    def get_digest(data):
+        if isinstance(data, str):
+            data = data.encode('utf_8')
+        else:
+            data = bytes(data)
+
+        # Ignore the differences in the segment terminators
+        digest = hashlib.sha256()
+        for segment in _SEGMENTS.findall(data):
+            digest.update(segment)
+            digest.update(b'\r')
+        return digest.hexdigest()
+
+
+    # Internal method removing the least recently used entry. The lock
+    # must be held.
+    def _evict(self):
+        (key, value) = self.acks.popitem(last = False)
+        if self.db != None:
+            self.db.execute('DELETE FROM acks WHERE application=? AND facility=? AND control_id=?', key)
+            self.db.commit()
+
+
+    # Return the acknowledgment that was sent for the message with the
+    # given key and digest, or "None" if the message was not processed
+    # yet (or if its entry has expired, if the key is "None", or if
+    # another message was processed with the same key).
+    def get(self, key, digest):
+        if key == None:
+            return None
+
+        with self.lock:
+            value = self.acks.get(key)
+            if value == None:
+                return None
+            elif value[0] < time.time():
+                self.acks.move_to_end(key, last = False)
+                self._evict()
+                return None
+            elif value[2] != digest:
+                return None  # Same control ID, but different message
+            else:
+                self.acks.move_to_end(key)
+                return value[1]
+
+
+    def add(self, key, ack, digest):
+        if key == None:
+            return
+
+        with self.lock:
+            expiration = time.time() + self.ttl
+            self.acks[key] = (expiration, ack, digest)
+            self.acks.move_to_end(key)
+            if self.db != None:
+                self.db.execute('INSERT OR REPLACE INTO acks VALUES (?, ?, ?, ?, ?, ?)', key + (expiration, ack, digest))
+                self.db.commit()
+
+            while len(self.acks) > self.max_entries:
+                self._evict()
+
+
+    def clear(self):
+        with self.lock:
+            self.acks = collections.OrderedDict()
+            if self.db != None:
+                self.db.execute('DELETE FROM acks')
+                self.db.commit()
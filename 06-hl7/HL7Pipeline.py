@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2025, Sebastien Jodogne, ICTEAM UCLouvain, Belgium
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import HL7Toolbox
+
+import concurrent.futures
+import queue
+import threading
+
+
+# Class implementing a pipeline stage that processes HL7 messages
+# concurrently, while preserving the order of the messages about the
+# same patient. The messages are sharded according to their patient
+# identifier (PID-3) onto "workers" threads, each with its own queue:
+# The messages about one patient are always handled by the same
+# thread in the order of their submission, whereas different patients
+# are processed in parallel.
+#
+# Each queue is bounded to "max_queue_size" messages. If the queue of
+# the target shard is full, "submit()" blocks until some room is
+# available (backpressure), or raises an exception after "timeout"
+# seconds if a timeout is provided.
+class PatientPipeline:
+
+    def __init__(self, handler, workers = 8, max_queue_size = 100):
+        self.handler = handler
+        self.queues = [ queue.Queue(maxsize = max_queue_size) for i in range(workers) ]
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depths = [ 0 ] * workers
+        self.threads = []
+
+        for i in range(workers):
+            thread = threading.Thread(target = self._run_worker, args = (i, ), daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    # Internal method executed by each worker thread
+    def _run_worker(self, shard):
+        while True:
+            item = self.queues[shard].get()
+            if item == None:
+                break
+
+            (message, future) = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.handler(message))
+                    success = True
+                except Exception as e:
+                    future.set_exception(e)
+                    success = False
+
+                with self.lock:
+                    if success:
+                        self.processed += 1
+                    else:
+                        self.failed += 1
+
+
+    # Return the index of the worker that is responsible for the given
+    # patient identifier
+    def get_shard(self, patient_id):
+        return hash(patient_id) % len(self.queues)
+
+
+    # Submit one HL7 message (as a string or an array of bytes) to the
+    # pipeline, and return a "concurrent.futures.Future" object that
+    # will contain the result of the handler. If "patient_id" is not
+    # provided, it is extracted from the PID-3 field of the message.
+    def submit(self, message, patient_id = None, timeout = None):
+        if patient_id == None:
+            patient_id = get_patient_id(message)
+
+        shard = self.get_shard(patient_id)
+        future = concurrent.futures.Future()
+
+        try:
+            self.queues[shard].put((message, future), timeout = timeout)
+        except queue.Full:
+            raise Exception('The HL7 pipeline is saturated (queue of worker %d is full)' % shard)
+
+        with self.lock:
+            self.submitted += 1
+            self.max_depths[shard] = max(self.max_depths[shard], self.queues[shard].qsize())
+
+        return future
+
+
+    # Return a dictionary of metrics about the pipeline: Current and
+    # maximum depths of the queue of each worker, and counters of the
+    # submitted, processed, and failed messages.
+    def get_metrics(self):
+        with self.lock:
+            return {
+                'queue-depths' : [ x.qsize() for x in self.queues ],
+                'max-queue-depths' : list(self.max_depths),
+                'submitted' : self.submitted,
+                'processed' : self.processed,
+                'failed' : self.failed,
+                'pending' : self.submitted - self.processed - self.failed,
+            }
+
+
+    # Stop the worker threads, once all the submitted messages have
+    # been processed
+    def shutdown(self):
+        for q in self.queues:
+            q.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+
+# Return the patient identifier (first component of PID-3) of a HL7
+# message, or "None" if the message has no PID segment. "None" is
+# also returned if the message cannot be parsed, so that the handler
+# still gets a chance to answer with a negative acknowledgment.
+def get_patient_id(message):
+    try:
+        return str(HL7Toolbox.parse_message(message).segment('PID')[3][0][0][0])
+    except Exception:
+        return None
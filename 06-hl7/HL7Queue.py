@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2025, Sebastien Jodogne, ICTEAM UCLouvain, Belgium
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import HL7Pipeline
+
+import collections
+import sqlite3
+import threading
+import time
+
+
+# Class implementing a durable queue of inbound HL7 messages, which
+# enables the "accept-then-apply" mode: A message is first appended
+# to a write-ahead log stored in a SQLite database, so that it can be
+# acknowledged right away with a commit acknowledgment ("CA"), then
+# it is applied in the background by the "handler" callback (that
+# takes the message as an array of bytes, and returns its HL7
+# acknowledgment as a string, typically
+# "student.process_hl7_message").
+#
+# The messages are applied through a "HL7Pipeline.PatientPipeline",
+# and the messages about the same patient are applied one at a time,
+# in the order in which they were accepted. A message is considered
+# as applied if the acknowledgment code (MSA-1) returned by the
+# handler is "AA". Transient failures (exceptions, or the "207"
+# application internal error in the ERR segment) are retried up to
+# "max_attempts" times with an exponential backoff (starting at
+# "retry_delay" seconds), after which the message is moved to the
+# dead-letter table. Other failures (e.g., unsupported message type)
+# are moved to the dead-letter table right away. A message waiting
+# for a retry only delays the next messages of the same patient, and
+# never blocks a worker. The messages that were accepted but not
+# applied before the process stopped are applied again on the next
+# start.
+class DurableQueue:
+
+    def __init__(self, path, handler, workers = 8, max_attempts = 5, retry_delay = 1.0):
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.workers = workers
+        self.pipeline = None
+        self.thread = None
+        self.stopping = False
+        self.wakeup = threading.Event()
+        self.patients = {}    # Patient ID => deque of [ sequence, attempts, time of the next attempt ]
+        self.running = set()  # Patients whose first message is being applied
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'received TEXT, data BLOB, attempts INTEGER DEFAULT 0)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, '
+                        'received TEXT, data BLOB, attempts INTEGER, error TEXT)')
+        self.db.commit()
+
+
+    # Append one HL7 message (a string or an array of bytes) to the
+    # write-ahead log. Once this method returns, the message is stored
+    # on the disk, and can be acknowledged with a "CA" code. Returns
+    # the sequence number of the message in the log.
+    def append(self, message):
+        if isinstance(message, str):
+            message = message.encode('UTF-8')
+
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO messages (received, data) VALUES (datetime('now'), ?)",
+                                     (message, ))
+            self.db.commit()
+            sequence = cursor.lastrowid
+
+        self.wakeup.set()
+        return sequence
+
+
+    # Internal method that makes one attempt at applying a message of
+    # the log. It is executed by the workers of the pipeline, and
+    # never sleeps: If the failure is transient, the time of the next
+    # attempt is recorded, and the dispatcher will submit the message
+    # again once this time is reached.
+    def _apply(self, patient_id, sequence, message, attempts):
+        try:
+            ack = self.handler(message)
+            code = _get_acknowledgment_code(ack)
+            if code == 'AA':
+                error = None
+            else:
+                error = 'Acknowledgment code %s' % code
+            transient = _is_transient_failure(ack)
+        except Exception as e:
+            error = str(e)
+            transient = True
+
+        attempts += 1
+
+        with self.lock:
+            entries = self.patients[patient_id]
+
+            if error == None:
+                self.db.execute('DELETE FROM messages WHERE id=?', (sequence, ))
+                entries.popleft()
+            elif transient and attempts < self.max_attempts:
+                self.db.execute('UPDATE messages SET attempts=? WHERE id=?', (attempts, sequence))
+                entries[0][1] = attempts
+                entries[0][2] = time.time() + self.retry_delay * (2 ** (attempts - 1))
+            else:
+                self.db.execute('INSERT INTO dead_letters (id, received, data, attempts, error) '
+                                'SELECT id, received, data, ?, ? FROM messages WHERE id=?',
+                                (attempts, error, sequence))
+                self.db.execute('DELETE FROM messages WHERE id=?', (sequence, ))
+                entries.popleft()
+
+            self.db.commit()
+
+            if len(entries) == 0:
+                del self.patients[patient_id]
+            self.running.discard(patient_id)
+
+        self.wakeup.set()
+
+
+    # Internal method executed by the thread that dispatches the
+    # messages of the log to the pipeline. The new messages of the log
+    # are appended to the queue of their patient (the number of
+    # previous attempts being read from the log, which matters after a
+    # restart), and the first message of each patient is submitted to
+    # the pipeline once its previous message is applied and its retry
+    # delay has elapsed.
+    def _dispatch(self):
+        last = 0
+        while not self.stopping:
+            with self.lock:
+                rows = self.db.execute('SELECT id, data, attempts FROM messages WHERE id>? ORDER BY id LIMIT 1000',
+                                       (last, )).fetchall()
+
+            for (sequence, message, attempts) in rows:
+                patient_id = str(HL7Pipeline.get_patient_id(message))
+                with self.lock:
+                    if not patient_id in self.patients:
+                        self.patients[patient_id] = collections.deque()
+                    self.patients[patient_id].append([ sequence, attempts, 0 ])
+                last = sequence
+
+            now = time.time()
+            delay = 1.0
+            ready = []
+            with self.lock:
+                for (patient_id, entries) in self.patients.items():
+                    if not patient_id in self.running:
+                        if entries[0][2] <= now:
+                            ready.append((patient_id, entries[0][0], entries[0][1]))
+                            self.running.add(patient_id)
+                        else:
+                            delay = min(delay, entries[0][2] - now)
+
+            for i in range(len(ready)):
+                (patient_id, sequence, attempts) = ready[i]
+                with self.lock:
+                    message = self.db.execute('SELECT data FROM messages WHERE id=?', (sequence, )).fetchone() [0]
+
+                try:
+                    self.pipeline.submit((patient_id, sequence, message, attempts), patient_id = patient_id,
+                                         timeout = 1.0).add_done_callback(_log_failure)
+                except Exception as e:
+                    # Typically, the pipeline is saturated: Release the
+                    # remaining patients, that are submitted on the next loop
+                    print('Cannot submit a queued HL7 message: %s' % str(e))
+                    with self.lock:
+                        for item in ready[i :]:
+                            self.running.discard(item[0])
+                    break
+
+            if len(rows) == 0:
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+
+
+    # Start applying the messages of the log in the background
+    def start(self):
+        if self.thread == None:
+            self.stopping = False
+            self.patients = {}
+            self.running = set()
+            self.pipeline = HL7Pipeline.PatientPipeline(lambda item: self._apply(*item),
+                                                        workers = self.workers)
+            self.thread = threading.Thread(target = self._dispatch, daemon = True)
+            self.thread.start()
+
+
+    # Stop the background workers. The messages that were not applied
+    # yet remain in the log.
+    def stop(self):
+        if self.thread != None:
+            self.stopping = True
+            self.wakeup.set()
+            self.thread.join()
+            self.pipeline.shutdown()
+            self.thread = None
+            self.pipeline = None
+
+
+    # Return the number of messages that are waiting to be applied,
+    # and the number of messages in the dead-letter table
+    def get_metrics(self):
+        with self.lock:
+            return {
+                'pending' : self.db.execute('SELECT COUNT(*) FROM messages').fetchone() [0],
+                'dead-letters' : self.db.execute('SELECT COUNT(*) FROM dead_letters').fetchone() [0],
+            }
+
+
+    # Return the list of the messages in the dead-letter table, as
+    # dictionaries
+    def list_dead_letters(self):
+        with self.lock:
+            rows = self.db.execute('SELECT id, received, data, attempts, error FROM dead_letters ORDER BY id').fetchall()
+
+        return [ {
+            'id' : row[0],
+            'received' : row[1],
+            'message' : row[2],
+            'attempts' : row[3],
+            'error' : row[4],
+        } for row in rows ]
+
+
+    # Move one message from the dead-letter table back to the log, so
+    # that it is applied again
+    def retry_dead_letter(self, sequence):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM dead_letters WHERE id=?', (sequence, )).fetchone()
+            if row == None:
+                raise Exception('Unknown dead letter: %d' % sequence)
+
+            self.db.execute('DELETE FROM dead_letters WHERE id=?', (sequence, ))
+            self.db.commit()
+
+        return self.append(row[0])
+
+
+# Internal function returning the MSA-1 field of a HL7 acknowledgment
+def _get_acknowledgment_code(ack):
+    for segment in ack.replace('\n', '\r').split('\r'):
+        if segment.startswith('MSA'):
+            return segment[4 : 6]
+    return None
+
+
+# Internal function telling whether a negative acknowledgment reports
+# a transient failure, that is worth retrying: The handler reports
+# the unexpected errors (e.g., OpenMRS being unreachable) with the
+# "207" (application internal error) code in ERR-3.
+def _is_transient_failure(ack):
+    for segment in ack.replace('\n', '\r').split('\r'):
+        if segment.startswith('ERR'):
+            fields = segment.split('|')
+            if len(fields) > 3 and fields[3].split('^')[0] == '207':
+                return True
+    return False
+
+
+def _log_failure(future):
+    if future.exception() != None:
+        print('Error while applying a queued HL7 message: %s' % str(future.exception()))
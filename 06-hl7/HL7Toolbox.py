@@ -24,43 +24,435 @@
 
 
 import datetime
+import functools
 import hl7
-import threading
+import itertools
+import re
+import time
 
-_threadLock = threading.Lock()
-_messageIdSequence = 0
+_messageIdSequence = itertools.count(1)
+_formattedNow = (None, None)
 
+# Regular expressions that locate the segments of a message, accepting
+# "\r", "\n", and "\r\n" as segment terminators
+_SEGMENTS_BYTES = re.compile(rb'[^\r\n]+')
+_SEGMENTS_STR = re.compile(r'[^\r\n]+')
+
+
+# Node in the tree of a lazily-parsed HL7 field. Like in "python-hl7",
+# a field contains repetitions, a repetition contains components, and
+# a component contains sub-components (which are plain strings). If a
+# part of a field contains no separator, it is stored as a node with
+# one single string child.
+class LazyContainer(list):
+    __slots__ = ('separator', )
+
+    def __init__(self, separator, sequence):
+        super().__init__(sequence)
+        self.separator = separator
+
+    def __str__(self):
+        return self.separator.join(map(str, self))
+
+
+# Split the text of a field following the same rules as "python-hl7".
+# The "separators" argument contains the repetition, component, and
+# sub-component separators.
+def _split_field(text, separators, level = 0):
+    if level == len(separators):
+        return text
+
+    for separator in separators[level :]:
+        if separator in text:
+            break
+    else:
+        return LazyContainer(separators[level], [ text ])
+
+    return LazyContainer(separators[level],
+                         [ _split_field(x, separators, level + 1) for x in text.split(separators[level]) ])
+
+
+# Mapping from the values of MSH-18 (character set, HL7 table 0211)
+# to the Python codecs. "ISO IR14" (JIS X 0201 Roman) has no Python
+# codec, and falls back to the default encoding.
+HL7_CHARACTER_SETS = {
+    'ASCII' : 'ascii',
+    '8859/1' : 'iso8859_1',
+    '8859/2' : 'iso8859_2',
+    '8859/3' : 'iso8859_3',
+    '8859/4' : 'iso8859_4',
+    '8859/5' : 'iso8859_5',
+    '8859/6' : 'iso8859_6',
+    '8859/7' : 'iso8859_7',
+    '8859/8' : 'iso8859_8',
+    '8859/9' : 'iso8859_9',
+    '8859/15' : 'iso8859_15',
+    'ISO IR6' : 'ascii',
+    'ISO IR87' : 'iso2022_jp',
+    'ISO IR159' : 'iso2022_jp_1',
+    'GB 18030-2000' : 'gb18030',
+    'KS X 1001' : 'euc_kr',
+    'BIG-5' : 'big5',
+    'UNICODE UTF-8' : 'utf_8',
+}
+
+
+# Codecs whose multi-byte characters can contain bytes that are equal
+# to the ASCII separators (e.g., "\xca|" in Big5). The messages using
+# those codecs are decoded as a whole before being split, instead of
+# being split in their raw bytes.
+_MULTIBYTE_UNSAFE_CODECS = frozenset([
+    'big5',
+    'gb18030',
+    'iso2022_jp',
+    'iso2022_jp_1',
+])
+
+
+# One segment of a "LazyMessage". A segment only stores its offsets
+# in the data of the message. The offsets of the fields are located
+# incrementally, only up to the field that is accessed, and each
+# field is decoded and split into its components only on its first
+# access. The raw data is never copied before being decoded.
+class LazySegment:
+    __slots__ = ('_message', '_start', '_end', '_fields', '_position', '_cache')
+
+    def __init__(self, message, start, end):
+        self._message = message
+        self._start = start    # Offset of the segment in the message
+        self._end = end
+        self._fields = None    # Offsets (start, end) of the fields located so far
+        self._position = None  # Offset where to look for the next field (-1 if done)
+        self._cache = {}       # Index of a field => decoded field
+
+    # Internal method returning the offsets of the fields, located at
+    # least up to the given index ("None" to locate all the fields)
+    def _get_fields(self, index = None):
+        if self._fields == None:
+            if self._message._is_header(self._start, self._end):
+                # The field separator is the field MSH-1 of the header
+                # segments, and it is followed by the encoding characters
+                self._fields = [ (self._start, self._start + 3), (self._start + 3, self._start + 4) ]
+                self._position = self._start + 4
+            else:
+                self._fields = []
+                self._position = self._start
+
+        fields = self._fields
+        position = self._position
+        if position != -1 and (index == None or index < 0 or index >= len(fields)):
+            data = self._message._data
+            separator = self._message._raw_field_separator
+            end = self._end
+
+            while index == None or index < 0 or index >= len(fields):
+                next_separator = data.find(separator, position, end)
+                if next_separator == -1:
+                    fields.append((position, end))
+                    position = -1
+                    break
+                else:
+                    fields.append((position, next_separator))
+                    position = next_separator + 1
+
+            self._position = position
+
+        return fields
+
+    def __len__(self):
+        return len(self._get_fields())
+
+    def __getitem__(self, index):
+        field = self._cache.get(index)
+        if field == None:
+            fields = self._get_fields(index)
+            text = self._message._decode(*fields[index])
+            if (index == 1 or index == 2) and self._message._is_header(self._start, self._end):
+                # The separators are never split
+                field = LazyContainer(self._message.separators[0], [ text ])
+            else:
+                field = _split_field(text, self._message.separators)
+            self._cache[index] = field
+        return field
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Return the text of one field, without splitting it into its
+    # components. This is equivalent to "str(segment[index])", but
+    # faster. An empty string is returned if the field does not exist.
+    def get_text(self, index):
+        fields = self._get_fields(index)
+        if index < len(fields):
+            return self._message._decode(*fields[index])
+        else:
+            return ''
+
+    def __str__(self):
+        return self._message._decode(self._start, self._end)
+
+
+# HL7 message that is parsed lazily. At construction time, the
+# message is scanned once to locate its segments, without decoding or
+# copying them. The segment terminators ('\r', '\n', or '\r\n') are
+# normalized during this scan. The fields are only decoded when they
+# are accessed, using the character set that is specified in MSH-18
+# (unless an explicit "encoding" is provided; UTF-8 is used by
+# default). The access paths are the same as with "python-hl7" (e.g.,
+# "msg[1][3]", "msg.segment('PID')[3][0][0][0]", or
+# "msg.segments('OBX')"), which makes it possible to use this class as
+# a faster replacement for "hl7.Message" if only a few fields are of
+# interest.
+class LazyMessage:
+
+    def __init__(self, data, encoding = None):
+        self._data = data
+        self._index = None  # Segment identifier => list of segments
+
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            if isinstance(data, memoryview):
+                # The offsets are computed with "bytes.find()", so a
+                # copy is only needed if the view is a slice
+                if (data.contiguous and data.format == 'B' and
+                    isinstance(data.obj, (bytes, bytearray)) and data.nbytes == len(data.obj)):
+                    self._data = data = data.obj
+                else:
+                    self._data = data = data.tobytes()
+            self._view = memoryview(data)
+            self._headers = (b'MSH', b'BHS', b'FHS')
+            spans = _SEGMENTS_BYTES.finditer(data)
+        else:
+            self._view = None
+            self._headers = ('MSH', 'BHS', 'FHS')
+            spans = _SEGMENTS_STR.finditer(data)
+
+        self._segments = [ LazySegment(self, m.start(), m.end()) for m in spans ]
+
+        if len(self._segments) == 0 or data[self._segments[0]._start : self._segments[0]._start + 3] not in self._headers:
+            raise Exception('The first segment must be one of MSH, BHS or FHS')
+
+        # Extract the separators from the header, defaults being used
+        # if they are not present (same logic as "python-hl7")
+        first = self._segments[0]
+        self._raw_field_separator = data[first._start + 3 : first._start + 4]
+        self._encoding = 'latin-1'  # To read the separators and MSH-18, that are ASCII
+
+        encoding_characters = first.get_text(2)
+        self.field_separator = first.get_text(1)
+        self.separators = (
+            encoding_characters[1] if len(encoding_characters) > 1 else '~',  # Repetition
+            encoding_characters[0] if len(encoding_characters) > 0 else '^',  # Component
+            encoding_characters[3] if len(encoding_characters) > 3 else '&',  # Sub-component
+        )
+
+        if encoding == None:
+            encoding = get_message_encoding(first)
+
+        if self._view != None and encoding in _MULTIBYTE_UNSAFE_CODECS:
+            # The separators cannot be looked for in the raw bytes
+            self.__init__(str(self._view, encoding), encoding)
+        else:
+            self._encoding = encoding
+
+    def _is_header(self, start, end):
+        return (self._data[start : start + 3] in self._headers and
+                end > start + 3)
+
+    def _decode(self, start, end):
+        if self._view == None:
+            return self._data[start : end]
+        else:
+            return str(self._view[start : end], self._encoding)
+
+    def __len__(self):
+        return len(self._segments)
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and len(key) == 3:
+            return self.segments(key)
+        else:
+            return self._segments[key]
+
+    def __iter__(self):
+        return iter(self._segments)
+
+    def __str__(self):
+        # The message ends with a carriage return, as in "python-hl7"
+        return ''.join([ str(x) + '\r' for x in self._segments ])
+
+    # Return the list of the segments with the given identifier.
+    # Raises "KeyError" if no such segment exists.
+    def segments(self, segment_id):
+        if self._index == None:
+            # Index the segments by their identifier on the first call
+            index = {}
+            data = self._data
+            for segment in self._segments:
+                start = segment._start
+                if (segment._end == start + 3 or
+                    data[start + 3 : start + 4] == self._raw_field_separator):
+                    key = data[start : start + 3]
+                    if not isinstance(key, str):
+                        key = key.decode('latin-1')
+                    index.setdefault(key, []).append(segment)
+            self._index = index
+
+        matches = self._index.get(segment_id)
+        if matches == None:
+            raise KeyError('No %s segments' % segment_id)
+        else:
+            return list(matches)
+
+    # Return the first segment with the given identifier. Raises
+    # "KeyError" if no such segment exists.
+    def segment(self, segment_id):
+        return self.segments(segment_id) [0]
+
+
+# Return the Python codec corresponding to the character set of a HL7
+# message, as specified in its MSH-18 field (only the first repetition
+# is considered). The "msh" argument can be a "LazySegment", a
+# "python-hl7" segment, or the raw MSH segment as an array of bytes.
+# If MSH-18 is absent or unknown, the "default" codec is returned.
+def get_message_encoding(msh, default = 'utf_8'):
+    if isinstance(msh, (bytes, bytearray)):
+        msh = LazyMessage(bytes(msh), encoding = 'latin-1')[0]
+
+    if isinstance(msh, LazySegment):
+        charset = msh.get_text(18).split(msh._message.separators[0]) [0]
+    elif len(msh) > 18:
+        charset = str(msh[18][0])
+    else:
+        charset = ''
+
+    return HL7_CHARACTER_SETS.get(charset.strip().upper(), default)
+
+
+# This function parses a string or an array of bytes. By default, the
+# message is parsed lazily using the "LazyMessage" class, which is
+# much faster than "python-hl7" if only a few fields are accessed, and
+# which offers the same access paths. If "lazy" is "False", the full
+# "python-hl7" object tree is built. In both cases, the character set
+# specified in MSH-18 is used to decode arrays of bytes (UTF-8 by
+# default), and the newline characters are normalized, which is useful
+# to enhance the flexibility of "python-hl7".
+def parse_message(data, lazy = True):
+    if lazy:
+        return LazyMessage(data)
 
-# This function parses a string or an array of bytes using the
-# "python-hl7" library. This function implements some normalization of
-# the newline characters, which is useful to enhance the flexibility
-# of "python-hl7".
-def parse_message(data):
     if isinstance(data, bytes):
-        # First convert to a standard "str" object, assuming UTF-8
-        # encoding. More advanced implementations would take the
-        # MSH-18 field into consideration to select the proper encoding.
-        data = data.decode('UTF-8')
+        # First convert to a standard "str" object
+        first = _SEGMENTS_BYTES.search(data)
+        if first == None:
+            data = data.decode('utf_8')
+        else:
+            data = data.decode(get_message_encoding(first.group(0)))
 
-    # The python-hl7 library expects newlines to separated by '\r'
-    # characters, so we first normalize the data
-    data = data.replace('\r\n', '\n')  # Compatibility with DOS line endings
-    data = data.replace('\n', '\r')
-    
-    return hl7.parse(data)
+    # The python-hl7 library expects segments to be separated by '\r'
+    # characters, so we normalize the data in one single pass
+    return hl7.parse('\r'.join(_SEGMENTS_STR.findall(data)))
 
 
 # This function generates a sequence of message identifiers, to be
 # used when creating a new HL7 message. Such identifiers can notably
 # be written to the MSH-10 (message control ID) field of the MSH
-# segment. Note that the implementation is thread-safe by the use of a
-# mutex.
+# segment. Note that the implementation is thread-safe without a
+# mutex, as "next()" on "itertools.count" is atomic in CPython.
 def generate_message_id():
-    global _messageIdSequence
-    global _threadLock
-    with _threadLock:
-        _messageIdSequence += 1
-        return 'LINFO2381_MSG_ID_%d' % _messageIdSequence
+    return 'LINFO2381_MSG_ID_%d' % next(_messageIdSequence)
+
+
+# Templates of the segments of an acknowledgment. The fields of the
+# MSH segment are: MSH-2 (encoding characters), MSH-3/4 (sending
+# application/facility), MSH-5/6 (receiving application/facility),
+# MSH-7 (date/time), MSH-9 (message type), MSH-10 (control ID),
+# MSH-11 (processing ID), and MSH-12 (version).
+_ACK_MSH_TEMPLATE = 'MSH|%s|%s|%s|%s|%s|%s||%s|%s|P|%s\r'
+_ACK_MSA_TEMPLATE = 'MSA|%s|%s\r'
+_ACK_MSA_TEXT_TEMPLATE = 'MSA|%s|%s|%s\r'
+_ACK_ERR_TEMPLATE = 'ERR|||%s^%s^HL70357|%s||||%s\r'
+
+# Fields of the original MSH segment that are copied into the
+# acknowledgment: MSH-2, MSH-5, MSH-6, MSH-3, MSH-4, MSH-9, MSH-10,
+# and MSH-12
+_ACK_MSH_FIELDS = (2, 5, 6, 3, 4, 9, 10, 12)
+
+# Table to escape the separators in the text fields (default encoding characters)
+_ESCAPE_TABLE = str.maketrans({
+    '\\' : '\\E\\',
+    '|' : '\\F\\',
+    '^' : '\\S\\',
+    '&' : '\\T\\',
+    '~' : '\\R\\',
+    '\r' : ' ',
+    '\n' : ' ',
+})
+
+# Values of the "HL7 error code" table (HL70357) for the ERR segment
+HL7_ERROR_CODES = {
+    '0' : 'Message accepted',
+    '100' : 'Segment sequence error',
+    '101' : 'Required field missing',
+    '102' : 'Data type error',
+    '103' : 'Table value not found',
+    '200' : 'Unsupported message type',
+    '201' : 'Unsupported event code',
+    '202' : 'Unsupported processing id',
+    '203' : 'Unsupported version id',
+    '204' : 'Unknown key identifier',
+    '205' : 'Duplicate key identifier',
+    '206' : 'Application record locked',
+    '207' : 'Application internal error',
+}
+
+
+# Escape the separators in a text, so that it can be written into a
+# field of a HL7 message using the default encoding characters.
+def escape_text(text):
+    return text.translate(_ESCAPE_TABLE)
+
+
+# Generate the acknowledgment (ACK) of a HL7 message, given its MSH
+# segment (either a "LazySegment", a "python-hl7" segment, or "None"
+# if the message could not be parsed). The sending and receiving
+# applications and facilities are swapped. The "code" is written to
+# MSA-1 (e.g., "AA", "AE", "AR", "CA", "CE", or "CR"), and the control
+# ID of the original message (MSH-10) to MSA-2. If an "error_message"
+# is provided, it is written to MSA-3. If an "error_code" from table
+# HL70357 is provided (e.g., "207" for an internal error), an ERR
+# segment is added, with the given "severity" ("E" for error, "W" for
+# warning, or "I" for information).
+def format_acknowledgment(msh, code, error_message = None, error_code = None, severity = 'E'):
+    if msh == None:
+        fields = ('^~\\&', '', '', '', '', '', '', '2.3')
+    else:
+        if isinstance(msh, LazySegment):
+            fields = tuple(map(msh.get_text, _ACK_MSH_FIELDS))
+        else:
+            count = len(msh)
+            fields = tuple(str(msh[i]) if i < count else '' for i in _ACK_MSH_FIELDS)
+
+        if fields[7] == '':
+            fields = fields[0 : 7] + ('2.3', )
+
+        # Only keep the message code and the trigger event of MSH-9
+        message_type = fields[5].split(fields[0][0 : 1] or '^')
+        fields = fields[0 : 5] + ('^'.join(message_type[0 : 2]), ) + fields[6 : 8]
+
+    ack = _ACK_MSH_TEMPLATE % (fields[0], fields[1], fields[2], fields[3], fields[4],
+                               format_now(), fields[5], generate_message_id(), fields[7])
+
+    if error_message == None:
+        ack += _ACK_MSA_TEMPLATE % (code, fields[6])
+    else:
+        ack += _ACK_MSA_TEXT_TEMPLATE % (code, fields[6], escape_text(error_message))
+
+    if error_code != None:
+        ack += _ACK_ERR_TEMPLATE % (error_code, HL7_ERROR_CODES.get(error_code, ''), severity,
+                                    escape_text(error_message or ''))
+
+    return ack
 
 
 # Return the current "datetime".
@@ -74,22 +466,77 @@ def format_date_time(date_time):
     return datetime.datetime.strftime(date_time, '%Y%m%d%H%M%S')
 
 
-# Format the current Date/Time for use in HL7 messages.
+# Format the current Date/Time for use in HL7 messages. The formatted
+# value is cached for the current second, as it is needed for each
+# generated message.
 def format_now():
-    return format_date_time(get_now())
+    global _formattedNow
+    second = int(time.time())
+    cached = _formattedNow
+    if cached[0] != second:
+        cached = (second, format_date_time(datetime.datetime.utcfromtimestamp(second)))
+        _formattedNow = cached
+    return cached[1]
+
+
+# Internal function parsing a HL7 "DTM" (Date/Time) value, whose
+# grammar is "YYYY[MM[DD[HH[MM[SS[.S[S[S[S]]]]]]]]][+/-ZZZZ]". The
+# fields are extracted by slicing at fixed offsets, which is much
+# faster than "datetime.strptime()". The results are memoized, as the
+# same timestamps are often repeated in a message (e.g., OBR-7 and
+# OBX-14) or in a batch of messages.
+@functools.lru_cache(maxsize = 4096)
+def _parse_dtm(value):
+    tz = None
+    sign = max(value.find('+'), value.find('-'))
+    if sign != -1:
+        offset = value[sign + 1 :]
+        if len(offset) != 4 or not offset.isdigit():
+            raise Exception('Unsupported date time format: %s' % value)
+
+        minutes = int(offset[0 : 2]) * 60 + int(offset[2 : 4])
+        tz = datetime.timezone(datetime.timedelta(minutes = minutes if value[sign] == '+' else -minutes))
+        value = value[0 : sign]
+
+    microsecond = 0
+    dot = value.find('.')
+    if dot != -1:
+        fraction = value[dot + 1 :]
+        if dot != 14 or len(fraction) < 1 or len(fraction) > 4 or not fraction.isdigit():
+            raise Exception('Unsupported date time format: %s' % value)
+
+        microsecond = int(fraction) * (10 ** (6 - len(fraction)))
+        value = value[0 : dot]
+
+    if not value.isdigit() or len(value) not in (4, 6, 8, 10, 12, 14):
+        raise Exception('Unsupported date time format: %s' % value)
+
+    size = len(value)
+    return datetime.datetime(int(value[0 : 4]),
+                             int(value[4 : 6]) if size >= 6 else 1,
+                             int(value[6 : 8]) if size >= 8 else 1,
+                             int(value[8 : 10]) if size >= 10 else 0,
+                             int(value[10 : 12]) if size >= 12 else 0,
+                             int(value[12 : 14]) if size >= 14 else 0,
+                             microsecond, tz)
 
 
 # Convert a HL7 field of "DTM" (Date/Time) data type to a "datetime"
-# Python class.
+# Python class. The full DTM grammar is supported, from the year alone
+# up to the fractions of seconds. If a timezone offset is present, the
+# resulting "datetime" is timezone-aware.
 def parse_date_time(hl7_date_time):
     if not isinstance(hl7_date_time, str):
         hl7_date_time = str(hl7_date_time)
 
-    if len(hl7_date_time) == 8:
-        return datetime.datetime.strptime(hl7_date_time, '%Y%m%d')
-    if len(hl7_date_time) == 12:
-        return datetime.datetime.strptime(hl7_date_time, '%Y%m%d%H%M')
-    elif len(hl7_date_time) == 14:
-        return datetime.datetime.strptime(hl7_date_time, '%Y%m%d%H%M%S')
-    else:
-        raise Exception('Unsupported date time format: %s' % hl7_date_time)
+    return _parse_dtm(hl7_date_time.strip())
+
+
+# Convert a list of HL7 fields of "DTM" (Date/Time) data type to a
+# list of "datetime" Python classes. This is faster than calling
+# "parse_date_time()" on each item, which is notably useful for batch
+# files. The values are normalized in the same way as by
+# "parse_date_time()", before looking up the cache.
+def parse_date_times(hl7_date_times):
+    parse = _parse_dtm
+    return [ parse((x if isinstance(x, str) else str(x)).strip()) for x in hl7_date_times ]
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024-2025, Sebastien Jodogne, ICTEAM UCLouvain, Belgium
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import HL7Pipeline
+import HL7Toolbox
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+# Framing characters of the Minimal Lower Layer Protocol (MLLP)
+START_BLOCK = b'\x0b'
+END_BLOCK = b'\x1c\x0d'
+
+_logger = logging.getLogger(__name__)
+
+# Default maximum size of one MLLP frame (HL7 messages with embedded
+# documents in OBX-5 easily exceed the 64KB default of asyncio)
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+# Exception raised by "read_frame()" if a MLLP frame is larger than
+# the limit of the "asyncio.StreamReader". The frame is discarded,
+# but its beginning is kept in "header", so that the MSH segment can
+# be used to answer with a negative acknowledgment.
+class FrameTooLargeError(Exception):
+
+    def __init__(self, header):
+        super().__init__('MLLP frame larger than the limit of the stream')
+        self.header = header
+
+
+# Wrap one HL7 message (a string or an array of bytes) into a MLLP
+# frame
+def frame_message(message):
+    if isinstance(message, str):
+        message = message.encode('UTF-8')
+    return START_BLOCK + message + END_BLOCK
+
+
+# Read one MLLP frame from an "asyncio.StreamReader", and return the
+# HL7 message it contains as an array of bytes. Returns "None" if the
+# connection was closed by the peer. If the frame exceeds the limit of
+# the reader, it is skipped and "FrameTooLargeError" is raised.
+async def read_frame(reader):
+    header = None
+
+    while True:
+        try:
+            frame = await reader.readuntil(END_BLOCK)
+            break
+        except asyncio.LimitOverrunError as e:
+            # Consume the beginning of the oversized frame, and look
+            # again for its end
+            chunk = await reader.readexactly(max(1, e.consumed))
+            if header == None:
+                header = chunk
+        except asyncio.IncompleteReadError as e:
+            if header == None and len(e.partial.strip()) == 0:
+                return None
+            else:
+                raise Exception('Connection closed in the middle of a MLLP frame')
+
+    if header != None:
+        raise FrameTooLargeError(header)
+
+    start = frame.find(START_BLOCK)
+    if start == -1:
+        raise Exception('MLLP frame without a start block')
+
+    return frame[start + 1 : len(frame) - len(END_BLOCK)]
+
+
+# Class implementing an asyncio server for the MLLP protocol. Each
+# incoming message is passed to the "handler" callback, that takes
+# the message as an array of bytes and returns the HL7 acknowledgment
+# (typically "student.process_hl7_message"). As this callback
+# executes blocking calls (e.g., to the REST API of OpenMRS), it is
+# run by a "HL7Pipeline.PatientPipeline" with "workers" threads: The
+# messages about the same patient (PID-3) are processed in the order
+# in which they were received, as HL7 senders expect (e.g., an
+# ADT^A04 must be processed before the ORU^R01 of the same patient),
+# whereas different patients are processed in parallel, even if they
+# are sent over the same connection.
+#
+# On each connection, the messages are read ahead of their
+# processing, and the acknowledgments are written back in the order
+# of the messages as soon as they are available (pipelining). At most
+# "max_pending" messages are read ahead on each connection, after
+# which the server stops reading from the socket (backpressure).
+class MLLPServer:
+
+    def __init__(self, handler, host = '0.0.0.0', port = 2575, workers = 8, max_pending = 64,
+                 max_queue_size = 100, max_frame_size = DEFAULT_MAX_FRAME_SIZE):
+        self.host = host
+        self.port = port
+        self.max_pending = max_pending
+        self.max_frame_size = max_frame_size
+        self.pipeline = HL7Pipeline.PatientPipeline(handler, workers = workers,
+                                                    max_queue_size = max_queue_size)
+
+        # Dedicated threads to submit the messages to the pipeline, as
+        # these calls block while the pipeline is saturated, which must
+        # not starve the default executor of the event loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        self.server = None
+        self.loop = None
+        self.thread = None
+
+
+    # Internal method that reads the frames of one connection, and
+    # submits them to the processing pipeline.
+    async def _read_frames(self, reader, queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    message = await read_frame(reader)
+                except FrameTooLargeError as e:
+                    # Answer with a negative acknowledgment, without
+                    # closing the connection
+                    future = loop.create_future()
+                    future.set_result(_format_rejection(e.header, 'Message larger than %d bytes' %
+                                                        self.max_frame_size))
+                    await queue.put(future)
+                    continue
+
+                if message == None:
+                    break
+
+                # "submit()" blocks if the pipeline is saturated, so it
+                # must not be called from the event loop
+                future = await loop.run_in_executor(self.executor, self.pipeline.submit, message)
+                await queue.put(asyncio.wrap_future(future))
+        finally:
+            await queue.put(None)
+
+
+    # Internal method that waits for the processing of the messages of
+    # one connection, and writes back their acknowledgments.
+    async def _write_acks(self, writer, queue):
+        while True:
+            future = await queue.get()
+            if future == None:
+                break
+
+            ack = await future
+            writer.write(frame_message(ack))
+            await writer.drain()
+
+
+    # Internal method handling one connection. The reader and the
+    # writer run as two tasks: If one of them fails, the other one is
+    # cancelled, so that the reader never stays blocked on a full
+    # queue that is not consumed anymore.
+    async def _handle_connection(self, reader, writer):
+        queue = asyncio.Queue(maxsize = self.max_pending)
+        tasks = [
+            asyncio.ensure_future(self._read_frames(reader, queue)),
+            asyncio.ensure_future(self._write_acks(writer, queue)),
+        ]
+
+        try:
+            (done, pending) = await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() != None:
+                    _logger.warning('Error on MLLP connection: %s', str(task.exception()))
+        except asyncio.CancelledError:
+            pass  # The server is shutting down
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            # Discard the acknowledgments that will never be written
+            while not queue.empty():
+                future = queue.get_nowait()
+                if future == None:
+                    pass
+                elif future.done() and not future.cancelled():
+                    future.exception()  # Mark the exception (if any) as retrieved
+                else:
+                    future.cancel()
+
+            writer.close()
+
+
+    # Start listening for incoming connections. This coroutine must be
+    # run in an asyncio event loop.
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                 limit = self.max_frame_size)
+
+
+    # Start the server, and run it until it is stopped
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+
+    # Run the server in a background thread with its own event loop,
+    # which is useful to run the MLLP server alongside Flask. This
+    # method returns once the server is listening.
+    def start_in_thread(self):
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start())
+            started.set()
+            self.loop.run_forever()
+
+            # Cancel the connections that are still open
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+            self.loop.close()
+
+        self.thread = threading.Thread(target = run, daemon = True)
+        self.thread.start()
+        started.wait()
+
+
+    # Stop a server that was started by "start_in_thread()"
+    def stop(self):
+        if self.thread != None:
+            def shutdown():
+                self.server.close()
+                self.loop.stop()
+
+            self.loop.call_soon_threadsafe(shutdown)
+            self.thread.join()
+            self.thread = None
+
+        self.pipeline.shutdown()
+        self.executor.shutdown(wait = False)
+
+
+# Internal function that creates an "AR" acknowledgment for a message
+# that was rejected, given the beginning of this message
+def _format_rejection(header, error_message):
+    msh = None
+    start = header.find(b'MSH')
+    if start != -1:
+        end = len(header)
+        for separator in [ b'\r', b'\n' ]:
+            position = header.find(separator, start)
+            if position != -1:
+                end = min(end, position)
+
+        try:
+            msh = HL7Toolbox.parse_message(header[start : end]).segment('MSH')
+        except Exception:
+            pass  # Not a valid MSH segment, answer with an empty header
+
+    return HL7Toolbox.format_acknowledgment(msh, 'AR', error_message)
+
+
+if __name__ == '__main__':
+    import argparse
+    import student
+
+    parser = argparse.ArgumentParser(description = 'MLLP server forwarding HL7 messages to OpenMRS')
+
+    parser.add_argument('--port',
+                        type = int,
+                        default = 2575,
+                        help = 'TCP port of the MLLP server')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 8,
+                        help = 'Number of HL7 messages that are processed concurrently')
+    parser.add_argument('--max-frame-size',
+                        type = int,
+                        default = DEFAULT_MAX_FRAME_SIZE,
+                        help = 'Maximum size of one MLLP frame, in bytes')
+    parser.add_argument('--url',
+                        default = 'http://localhost:8003/openmrs/ws/rest',
+                        help = 'Address of the REST API of OpenMRS')
+    parser.add_argument('--username',
+                        default = 'admin',
+                        help = 'Username to the REST API')
+    parser.add_argument('--password',
+                        default = 'Admin123',
+                        help = 'Password to the REST API')
+    parser.add_argument('--queue',
+                        default = None,
+                        help = 'Path to a SQLite database to enable the accept-then-apply mode')
+    parser.add_argument('--deduplicate',
+                        action = 'store_true',
+                        help = 'Send back the cached acknowledgment if a message is received twice')
+
+    args = parser.parse_args()
+
+    student.app_initialize({
+        'url' : args.url,
+        'username' : args.username,
+        'password' : args.password,
+    }, queue_path = args.queue, deduplicate = args.deduplicate)
+
+    if args.queue == None:
+        handler = student.process_hl7_message
+    else:
+        handler = student.accept_hl7_message
+
+    server = MLLPServer(handler, port = args.port, workers = args.workers,
+                        max_frame_size = args.max_frame_size)
+
+    print('MLLP server listening on port %d' % args.port)
+    asyncio.run(server.serve_forever())
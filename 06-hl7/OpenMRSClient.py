@@ -234,9 +234,15 @@ class OpenMRSClient:
         return list(map(lambda x: x['uuid'], r.json() ['results']))
 
 
-    # Retrieve information about one visit, given its UUID.
-    def get_visit(self, visit_uuid):
-        r = requests.get('%s/v1/visit/%s' % (self.url, visit_uuid), auth = self.auth)
+    # Retrieve information about one visit, given its UUID. The
+    # optional "representation" is forwarded as the "v" argument of
+    # the REST API (e.g., "custom:(uuid,voided)").
+    def get_visit(self, visit_uuid, representation = None):
+        params = {}
+        if representation != None:
+            params['v'] = representation
+
+        r = requests.get('%s/v1/visit/%s' % (self.url, visit_uuid), params = params, auth = self.auth)
         r.raise_for_status()
         return r.json()
 
@@ -278,15 +284,21 @@ class OpenMRSClient:
     # Create a new encounter associated with the visit whose UUID is
     # provided as argument. In the OpenMRS Reference Application, the
     # "encounter_type" can be "Vitals", "Attachment Upload", or "Visit Note".
+    # If the UUID of the patient of the visit is already known, it can
+    # be provided as "patient_uuid" to save one request.
     # The method returns the UUID of the newly created encounter.
     def create_encounter(self, visit_uuid, encounter_type,
                          form = None,
                          location = _DEFAULT_LOCATION,
                          provider = _DEFAULT_PROVIDER,
                          role = _DEFAULT_ROLE,
-                         date_time = None):
+                         date_time = None,
+                         patient_uuid = None):
+        if patient_uuid == None:
+            patient_uuid = self.get_visit(visit_uuid) ['patient']['uuid']
+
         content = {
-            'patient' : self.get_visit(visit_uuid) ['patient']['uuid'],
+            'patient' : patient_uuid,
             'encounterType' : self._lookup_entity('encountertype', encounter_type),
             'visit' : visit_uuid,
             'encounterDatetime' : self.format_now(),
@@ -12,16 +12,22 @@
 # computer using Docker Compose (same as in exercise "05-openmrs").
 
 
+import HL7Cache
+import HL7Queue
 import HL7Toolbox
 import OpenMRSClient
 import flask
 import json
+import requests
 
 
 app = flask.Flask(__name__)
 
 
 global_credentials = None
+global_queue = None
+global_patient_index = HL7Cache.PatientIndex()
+global_deduplication_cache = None
 
 @app.route('/')
 def redirection():
@@ -41,9 +47,39 @@ def get_javascript():
 # Throughout the code, make sure to use the credentials contained in
 # the global variable "global_credentials" when creating the client
 # connections to OpenMRS.
-def app_initialize(credentials):
-    global global_credentials
+#
+# If "queue_path" is provided, the "accept-then-apply" mode is
+# enabled: The HL7 messages are stored in a durable queue (a SQLite
+# database at this path) and acknowledged right away with a "CA"
+# code, then they are applied to OpenMRS in the background.
+#
+# If "index_path" is provided, the index mapping the HL7 patient
+# identifiers to the UUIDs of OpenMRS is persisted in a SQLite
+# database at this path.
+#
+# If "deduplicate" is "True", the acknowledgments of the processed
+# messages are cached, and are sent back (without touching OpenMRS) if
+# a message with the same MSH-3, MSH-4, and MSH-10 fields is received
+# again. This cache is persisted in a SQLite database if
+# "deduplication_path" is provided.
+def app_initialize(credentials, queue_path = None, index_path = None,
+                   deduplicate = False, deduplication_path = None):
+    global global_credentials, global_queue, global_patient_index, global_deduplication_cache
     global_credentials = credentials
+    global_patient_index = HL7Cache.PatientIndex(index_path)
+
+    if deduplicate or deduplication_path != None:
+        global_deduplication_cache = HL7Cache.DeduplicationCache(deduplication_path)
+    else:
+        global_deduplication_cache = None
+
+    if global_queue != None:
+        global_queue.stop()
+        global_queue = None
+
+    if queue_path != None:
+        global_queue = HL7Queue.DurableQueue(queue_path, process_hl7_message)
+        global_queue.start()
 
 
 @app.route('/find-patient', methods = [ 'GET' ])
@@ -81,17 +117,16 @@ def find_patient():
                                          password=global_credentials['password'])
 
     try:
-        # Step 1: Look up patient by custom external identifier
-        patient_uuid = client.find_patient_by_custom_id(custom_id)
+        # Look up patient by custom external identifier, and check
+        # the number of visits for this patient
+        (patient_uuid, visits) = _resolve_patient(client, custom_id)
         if patient_uuid is None:
             return flask.Response('Patient not found\n', 404)
 
-        # Step 2: Check number of visits for this patient
-        visits = client.list_visits(patient_uuid)
         if len(visits) != 1:
             return flask.Response('Patient must have exactly one visit\n', 404)
 
-        # Step 3: Return JSON response with UUIDs
+        # Return JSON response with UUIDs
         return flask.jsonify({
             'patient-uuid': patient_uuid,
             'visit-uuid': visits[0]
@@ -165,14 +200,57 @@ def hl7_handler():
     # - As far as the MSH segment is concerned, you can focus on the
     #   following fields: MSH-3, MSH-4, MSH-5, MSH-6, MSH-7, MSH-9,
     #   MSH-10, and MSH-12.
+    if global_queue == None:
+        ack = process_hl7_message(flask.request.data)
+    else:
+        ack = accept_hl7_message(flask.request.data)
+
+    return flask.Response(ack, mimetype = 'text/hl7v2')
+
+
+# Store one HL7 message in the durable queue ("accept-then-apply"
+# mode), and return a commit acknowledgment: "CA" if the message was
+# stored, or "CR" if it is not a valid HL7 message.
+def accept_hl7_message(data):
+    try:
+        msg = HL7Toolbox.parse_message(data)
+        msh = msg.segment('MSH')
+        key = HL7Cache.DeduplicationCache.get_key(msh)
+    except Exception as e:
+        return _hl7_ack(None, 'CR', f'Error: {str(e)}')
+
+    # The message was already applied
+    if global_deduplication_cache != None:
+        cached = global_deduplication_cache.get(key, HL7Cache.DeduplicationCache.get_digest(data))
+        if cached != None:
+            return cached
 
+    global_queue.append(data)
+    return _hl7_ack(msh, 'CA')
+
+
+# Process one HL7 message given as a string or an array of bytes, and
+# return the HL7 acknowledgment as a string. This function does not
+# depend on Flask, which makes it possible to share the processing
+# logic of the "/hl7" route with other transports (e.g., MLLP).
+def process_hl7_message(data):
+    msh = None
     try:
-        # Parse the HL7 message from the request body
-        msg = HL7Toolbox.parse_message(flask.request.data)
+        # Parse the HL7 message
+        msg = HL7Toolbox.parse_message(data)
         msh = msg.segment('MSH')
         msg_type = msh[9][0]
-        msg_id = msh[10][0]
 
+        # If the message was already processed (e.g., if the sender
+        # did not receive the acknowledgment in time and resends the
+        # message), send back the same acknowledgment
+        key = HL7Cache.DeduplicationCache.get_key(msh)
+        digest = None
+        if global_deduplication_cache != None:
+            digest = HL7Cache.DeduplicationCache.get_digest(data)
+            cached = global_deduplication_cache.get(key, digest)
+            if cached != None:
+                return cached
 
         client = OpenMRSClient.OpenMRSClient(url=global_credentials['url'],
                                          username=global_credentials['username'],
@@ -186,7 +264,7 @@ def hl7_handler():
 
             event_type = evn[1][0]
 
-            custom_id = pid[3][0][0]  
+            custom_id = str(pid[3][0][0][0])
             family_name = pid[5][0][0][0]
             first_name = pid[5][0][1][0]
             birth_date = HL7Toolbox.parse_date_time(pid[7][0])
@@ -196,17 +274,19 @@ def hl7_handler():
             existing = client.find_patient_by_custom_id(custom_id)
             if existing:
                 client.delete_patient(existing)
+                global_patient_index.remove(custom_id)
 
             patient_uuid = client.create_patient(
                 given_name=first_name,
                 family_name=family_name,
                 gender=gender,
                 birth_date=birth_date,
-                custom_identifiers=custom_id
+                custom_identifiers=[ custom_id ]
             )
 
-            client.create_visit(patient_uuid, start_date_time=visit_time)
-            return _hl7_ack(msh, msg_id, 'AA')
+            visit_uuid = client.create_visit(patient_uuid, start_date_time=visit_time)
+            global_patient_index.add(custom_id, patient_uuid, visit_uuid)
+            return _remember_ack(key, digest, _hl7_ack(msh, 'AA'))
 
 
         elif msg_type[0][0] == 'ORU' and msg_type[1][0] == 'R01':
@@ -219,21 +299,21 @@ def hl7_handler():
             encounter_time = HL7Toolbox.parse_date_time(obr[7][0])
 
             if encounter_type not in ['Vitals', 'Visit Note']:
-                return _hl7_ack(msh, msg_id, 'AE', 'Unsupported encounter type')
+                return _hl7_ack(msh, 'AE', 'Unsupported encounter type')
 
-            patient_uuid = client.find_patient_by_custom_id(custom_id)
+            (patient_uuid, visits) = _resolve_patient(client, custom_id)
             if not patient_uuid:
-                return _hl7_ack(msh, msg_id, 'AE', 'Patient not found')
+                return _hl7_ack(msh, 'AE', 'Patient not found')
 
-            visits = client.list_visits(patient_uuid)
             if len(visits) != 1:
-                return _hl7_ack(msh, msg_id, 'AE', 'Invalid number of visits')
+                return _hl7_ack(msh, 'AE', 'Invalid number of visits')
 
             visit_uuid = visits[0]
             encounter_uuid = client.create_encounter(
                 visit_uuid,
                 encounter_type=encounter_type,
-                date_time=encounter_time
+                date_time=encounter_time,
+                patient_uuid=patient_uuid
             )
 
             for obx in obx_segments:
@@ -249,60 +329,65 @@ def hl7_handler():
                     if loinc == '11488-4':
                         client.create_observation(encounter_uuid, 'Text of encounter note', value)
 
-            return _hl7_ack(msh, msg_id, 'AA')
+            return _remember_ack(key, digest, _hl7_ack(msh, 'AA'))
 
         # -----------------------------
         # Unsupported message type
         # -----------------------------
         else:
-            return _hl7_ack(msh, msg_id, 'AE', 'Unsupported message type')
+            return _hl7_ack(msh, 'AE', 'Unsupported message type')
 
     except Exception as e:
-        return _hl7_ack(None, None, 'AE', f'Error: {str(e)}')
+        return _hl7_ack(msh, 'AE', f'Error: {str(e)}', '207')
 
     
 
-def _hl7_ack(msh, msg_id, code, error_message=None):
-    now        = HL7Toolbox.format_now()
-    new_ctrl   = HL7Toolbox.generate_message_id()
-
-    # Unwrap the usual MSH fields (each msh[i] is a one‑element list):
-    enc_chars  = msh[2][0]  if msh and len(msh)>2 else ''
-    orig_sapp  = msh[5][0]  if msh and len(msh)>5 else ''
-    orig_sfac  = msh[6][0]  if msh and len(msh)>6 else ''
-    orig_rapp  = msh[3][0]  if msh and len(msh)>3 else ''
-    orig_rfac  = msh[4][0]  if msh and len(msh)>4 else ''
-    orig_type0  = msh[9][0][0][0]  if msh and len(msh)>8 else ''
-    orig_type1 = msh[9][0][1][0]  if msh and len(msh)>8 else ''
-    orig_ver   = msh[11][0] if msh and len(msh)>11 else '2.3'
-
-
-    orig_type = orig_type0 + '^' + orig_type1
-    msh_fields = [
-        'MSH',         # segment name
-        enc_chars,     # MSH-2: encoding chars
-        orig_sapp,     # MSH-3: (was original MSH-5)
-        orig_sfac,     # MSH-4: (was original MSH-6)
-        orig_rapp,     # MSH-5: (was original MSH-3)
-        orig_rfac,     # MSH-6: (was original MSH-4)
-        now,           # MSH-7: timestamp
-        '',            # MSH-8: security (blank)
-        orig_type,     # MSH-9: original messageType^event
-        new_ctrl,      # MSH-10: new control ID
-        'P',           # MSH-11: processing ID
-        orig_ver       # MSH-12: version
-    ]
-    ack = ['|'.join(msh_fields) + '\r',
-           f"MSA|{code}|{msg_id or ''}\r"]
-
-
-
-    return flask.Response(''.join(ack), mimetype='text/hl7v2')
-
-
-
-
-
+# Look for the patient with the given custom identifier (PID-3), and
+# return a tuple containing its UUID and the list of the UUIDs of its
+# visits. The UUID is "None" if the patient cannot be found. The local
+# index is used if possible, which replaces the search for the
+# patient and the listing of its visits by one single GET request on
+# the indexed visit. This request checks that neither the visit nor
+# the patient were deleted in the meantime, and its answer can be
+# reused by "create_encounter()" through its "patient_uuid" argument.
+def _resolve_patient(client, custom_id):
+    indexed = global_patient_index.get(custom_id)
+    if indexed != None:
+        try:
+            visit = client.get_visit(indexed[1], 'custom:(uuid,voided,patient:(uuid,voided))')
+            if (not visit.get('voided', False) and
+                not visit['patient'].get('voided', False) and
+                visit['patient']['uuid'] == indexed[0]):
+                return (indexed[0], [ indexed[1] ])
+        except requests.exceptions.HTTPError:
+            pass  # The visit or the patient was purged
+
+        global_patient_index.remove(custom_id)
+
+    patient_uuid = client.find_patient_by_custom_id(custom_id)
+    if patient_uuid == None:
+        return (None, [])
+
+    visits = client.list_visits(patient_uuid)
+    if len(visits) == 1:
+        global_patient_index.add(custom_id, patient_uuid, visits[0])
+
+    return (patient_uuid, visits)
+
+
+# Store the acknowledgment of a successfully processed message in the
+# deduplication cache. The errors are not cached, so that a message
+# can be fixed on the OpenMRS side and sent again.
+def _remember_ack(key, digest, ack):
+    if global_deduplication_cache != None:
+        global_deduplication_cache.add(key, ack, digest)
+    return ack
+
+
+# Generate the acknowledgment of a HL7 message, given its MSH segment
+# ("None" if the message could not be parsed)
+def _hl7_ack(msh, code, error_message = None, error_code = None):
+    return HL7Toolbox.format_acknowledgment(msh, code, error_message, error_code)
 
 
 if __name__ == '__main__':
@@ -23,8 +23,14 @@
 # SOFTWARE.
 
 
+import collections
+import concurrent.futures
+import copy
+import itertools
 import requests
 import requests.auth
+import threading
+import uuid
 
 
 # Class that represents a connection to some FHIR server.
@@ -32,11 +38,14 @@ class FHIRClient:
 
     # Constructor for the FHIR connection: An URL, an username, and a
     # password are expected. It defaults to the base URL of the FHIR
-    # API an OpenMRS server running on the localhost.
+    # API an OpenMRS server running on the localhost. The
+    # "cache_size" parameter bounds the number of resources that are
+    # kept by "get_resource()" and "vread()" (zero disables the cache).
     def __init__(self,
                  url = 'http://localhost:8003/openmrs/ws/fhir2/R4',
                  username = 'admin',
-                 password = 'Admin123'):
+                 password = 'Admin123',
+                 cache_size = 256):
         # Make sure that the URL does not end with a slash
         if url.endswith('/'):
             self.url = url[0 : len(url) - 1]
@@ -44,45 +53,206 @@ class FHIRClient:
             self.url = url
 
         self.auth = requests.auth.HTTPBasicAuth(username, password)
+        self.cache = ResourceCache(cache_size)
+        self.transactions_supported = None  # Unknown until "is_transaction_supported()" is called
 
 
     # Return one FHIR Resource, given its type (typically "Patient",
     # "Encounter", or "Observation") and its FHIR identifier. This is
-    # an invokation of a FHIR "Instance service".
+    # an invokation of a FHIR "Instance service". If the resource was
+    # read before, a conditional read is issued (using the
+    # "If-None-Match" and "If-Modified-Since" HTTP headers), so that
+    # the FHIR server can answer with an empty "304 Not Modified"
+    # response if the resource has not changed.
     def get_resource(self, resource_type, resource_identifier):
-        r = requests.get('%s/%s/%s' % (self.url, resource_type, resource_identifier), auth = self.auth)
+        key = (resource_type, resource_identifier)
+        cached = self.cache.get(key)
+
+        headers = {}
+        if cached != None:
+            (etag, last_modified, resource) = cached
+            if etag != None:
+                headers['If-None-Match'] = etag
+            if last_modified != None:
+                headers['If-Modified-Since'] = last_modified
+
+        r = requests.get('%s/%s/%s' % (self.url, resource_type, resource_identifier),
+                         headers = headers, auth = self.auth)
+
+        if r.status_code == 304 and cached != None:
+            return copy.deepcopy(cached[2])
+
         r.raise_for_status()
-        return r.json()
+        resource = r.json()
 
+        etag = r.headers.get('ETag')
+        version = resource.get('meta', {}).get('versionId')
+        if etag == None and version != None:
+            etag = 'W/"%s"' % version
 
-    # List all the FHIR Resources of a given type that are stored in
-    # the FHIR server. The "criteria" parameters can be used to
-    # provide search criteria. This method implements paging. This is
-    # an invokation of a FHIR "Type service".
-    def list_resources(self, resource_type, criteria = {}, max_results = 20):
-        result = []
+        if etag != None or r.headers.get('Last-Modified') != None:
+            self.cache.add(key, (etag, r.headers.get('Last-Modified'), resource))
+        else:
+            self.cache.remove(key)  # The server does not support conditional reads
+
+        if version != None:
+            self.cache.add((resource_type, resource_identifier, version), resource)
+
+        return copy.deepcopy(resource)
 
-        next_url = '%s/%s' % (self.url, resource_type)
-        next_criteria = criteria
 
-        while True:
-            r = requests.get(next_url, params = next_criteria, auth = self.auth)
+    # Return one specific version of a FHIR Resource. This is an
+    # invokation of the FHIR "vread" interaction. As a version of a
+    # resource never changes, the FHIR server is not contacted if
+    # this version is already in the cache.
+    def vread(self, resource_type, resource_identifier, version):
+        key = (resource_type, resource_identifier, version)
+        resource = self.cache.get(key)
+
+        if resource == None:
+            r = requests.get('%s/%s/%s/_history/%s' % (self.url, resource_type, resource_identifier, version),
+                             auth = self.auth)
             r.raise_for_status()
+            resource = r.json()
+            self.cache.add(key, resource)
+
+        return copy.deepcopy(resource)
+
+
+    # Return the FHIR Resource targeted by a FHIR reference (either a
+    # "Reference" JSON object, or a string). If the reference is
+    # versioned (i.e., "Type/id/_history/version"), "vread()" is used.
+    def read_reference(self, reference):
+        if isinstance(reference, dict):
+            reference = reference.get('reference')
+
+        target = parse_reference(reference)
+        if target == None:
+            raise Exception('Not a literal FHIR reference: %s' % reference)
+
+        parts = reference.split('/')
+        if '_history' in parts and parts.index('_history') + 1 < len(parts):
+            return self.vread(target[0], target[1], parts[parts.index('_history') + 1])
+        else:
+            return self.get_resource(target[0], target[1])
+
+
+    # Internal method to download one page of a FHIR search, and to
+    # return the parsed Bundle.
+    def _get_bundle(self, url, params):
+        r = requests.get(url, params = params, auth = self.auth)
+        r.raise_for_status()
+        return r.json()
+
+
+    # Internal generator iterating over all the entries of a FHIR
+    # search, following the "next" links of the Bundles. If
+    # "prefetch" is "True", the next page is downloaded in the
+    # background while the caller consumes the current page.
+    def _iter_entries(self, resource_type, params, prefetch = False):
+        if prefetch:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        else:
+            executor = None
+
+        try:
+            bundle = self._get_bundle('%s/%s' % (self.url, resource_type), params)
+
+            while True:
+                next_url = None
+                for link in bundle.get('link', []):
+                    if link['relation'] == 'next':
+                        next_url = link['url']  # Where to query the rest of the search set
+                        break
+
+                if next_url != None and executor != None:
+                    next_bundle = executor.submit(self._get_bundle, next_url, {})
+                else:
+                    next_bundle = None
+
+                for entry in bundle.get('entry', []):
+                    yield entry
+
+                if next_url == None:
+                    return  # We are done
+                elif next_bundle != None:
+                    bundle = next_bundle.result()
+                else:
+                    bundle = self._get_bundle(next_url, {})
+        finally:
+            if executor != None:
+                executor.shutdown(wait = False)
 
-            for entry in r.json().get('entry', []):
-                result.append(entry['resource'])
-                if (max_results != 0 and
-                    len(result) >= max_results):
-                    return result
-
-            n = list(filter(lambda x: x['relation'] == 'next', r.json() ['link']))
-            if len(n) == 0:
-                return result  # We are done
-            elif len(n) == 1:
-                next_url = n[0]['url']  # Where to query the rest of the search set
-                next_criteria = {}
-            else:
-                assert(False)  # Should never happen
+
+    # Iterate over all the FHIR Resources of a given type that are
+    # stored in the FHIR server, as a generator. The "criteria"
+    # parameters can be used to provide search criteria. The search
+    # results are retrieved by pages of "page_size" resources (using
+    # the "_count" parameter), and the "next" links of the Bundles are
+    # only followed when the previous page has been consumed, so that
+    # large searches are streamed in constant memory. If "prefetch" is
+    # "True", the next page is downloaded in the background while the
+    # caller consumes the current page. This is an invokation of a FHIR
+    # "Type service".
+    def iter_resources(self, resource_type, criteria = {}, page_size = 100, prefetch = False):
+        params = dict(criteria)
+        if page_size != None:
+            params['_count'] = page_size
+
+        for entry in self._iter_entries(resource_type, params, prefetch):
+            yield entry['resource']
+
+
+    # Run one FHIR search, and return its results as a "ResourceGraph"
+    # object. Besides the "criteria", the resources referenced by the
+    # matches ("include", e.g. "Encounter:part-of") and the resources
+    # referring to the matches ("revinclude", e.g.
+    # "Observation:patient") can be retrieved by the same request,
+    # which avoids one round trip per related resource. The
+    # "elements" (list of field names) and "summary" (e.g. "true",
+    # "data", or "count") parameters reduce the size of the returned
+    # resources. All the pages of the search set are downloaded.
+    def search(self, resource_type, criteria = {}, include = [], revinclude = [],
+               elements = None, summary = None, page_size = 100):
+        params = dict(criteria)
+        if len(include) > 0:
+            params['_include'] = list(include)
+        if len(revinclude) > 0:
+            params['_revinclude'] = list(revinclude)
+        if elements != None:
+            params['_elements'] = ','.join(elements)
+        if summary != None:
+            params['_summary'] = summary
+        if page_size != None:
+            params['_count'] = page_size
+
+        graph = ResourceGraph()
+        for entry in self._iter_entries(resource_type, params):
+            if 'resource' in entry:
+                mode = entry.get('search', {}).get('mode')
+                if mode == None:
+                    # Some servers do not report the search mode
+                    is_match = (entry['resource']['resourceType'] == resource_type)
+                else:
+                    is_match = (mode == 'match')
+                graph.add(entry['resource'], is_match)
+
+        return graph
+
+
+    # List all the FHIR Resources of a given type that are stored in
+    # the FHIR server. The "criteria" parameters can be used to
+    # provide search criteria. This method implements paging, and
+    # returns at most "max_results" resources (all the resources if
+    # "max_results" is zero). This is an invokation of a FHIR "Type
+    # service".
+    def list_resources(self, resource_type, criteria = {}, max_results = 20):
+        if max_results == 0:
+            return list(self.iter_resources(resource_type, criteria))
+        else:
+            return list(itertools.islice(self.iter_resources(resource_type, criteria,
+                                                             page_size = min(max_results, 100)),
+                                         max_results))
 
 
     # Upload a new FHIR Resource onto the remote FHIR server. This is
@@ -98,3 +268,352 @@ class FHIRClient:
                           json = content, auth = self.auth)
         r.raise_for_status()
         return r.json()
+
+
+    # Generate a temporary URL ("urn:uuid:...") that identifies a new
+    # resource inside a transaction or batch Bundle. Other resources
+    # of the same Bundle can refer to the new resource by writing this
+    # URL in the "reference" field of a Reference.
+    @staticmethod
+    def generate_temporary_url():
+        return 'urn:uuid:%s' % str(uuid.uuid4())
+
+
+    # Internal method to build a transaction or batch Bundle. Each item
+    # of "entries" is either a FHIR resource (that will be created
+    # using a POST request, with a new temporary URL), or a dictionary
+    # with the field "resource", and the optional fields "fullUrl"
+    # (temporary URL of the resource), "method" (HTTP verb, defaults
+    # to "POST"), and "url" (defaults to the type of the resource).
+    def _build_bundle(self, bundle_type, entries):
+        bundle_entries = []
+
+        for entry in entries:
+            if 'resourceType' in entry:
+                entry = { 'resource' : entry }
+
+            resource = entry.get('resource')
+            if resource != None and not 'resourceType' in resource:
+                raise Exception('Missing field "resourceType" in FHIR Resource')
+
+            bundle_entry = {
+                'request' : {
+                    'method' : entry.get('method', 'POST'),
+                    'url' : entry.get('url', resource['resourceType'] if resource != None else ''),
+                },
+            }
+
+            if resource != None:
+                bundle_entry['resource'] = resource
+                bundle_entry['fullUrl'] = entry.get('fullUrl', self.generate_temporary_url())
+
+            bundle_entries.append(bundle_entry)
+
+        return {
+            'resourceType' : 'Bundle',
+            'type' : bundle_type,
+            'entry' : bundle_entries,
+        }
+
+
+    # Internal method to post a transaction or batch Bundle, and to
+    # return the list of its response entries, in the same order as
+    # the request entries.
+    def _post_bundle(self, bundle):
+        r = requests.post(self.url, json = bundle, auth = self.auth)
+        r.raise_for_status()
+
+        response = r.json().get('entry', [])
+        if len(response) != len(bundle['entry']):
+            raise Exception('The FHIR server returned %d entries for a Bundle with %d entries' %
+                            (len(response), len(bundle['entry'])))
+
+        return response
+
+
+    # Internal method that emulates a transaction Bundle by sending its
+    # entries one by one, for the FHIR servers that do not support
+    # transactions. The temporary URLs are replaced by the actual
+    # references as soon as the resources are created. Note that, in
+    # contrast with actual transactions, this is not atomic.
+    def _emulate_transaction(self, bundle):
+        references = {}  # Temporary URL => "Type/id"
+        response = []
+
+        for entry in bundle['entry']:
+            if entry['request']['method'] != 'POST':
+                raise Exception('Only POST requests can be emulated in a FHIR transaction')
+
+            resource = _replace_references(entry['resource'], references)
+            created = self.upload_resource(resource)
+
+            location = '%s/%s' % (created['resourceType'], created['id'])
+            references[entry['fullUrl']] = location
+            response.append({
+                'resource' : created,
+                'response' : {
+                    'status' : '201 Created',
+                    'location' : location,
+                },
+            })
+
+        return response
+
+
+    # Check whether the FHIR server supports transaction Bundles, as
+    # advertised by the "transaction" interaction of its
+    # CapabilityStatement. The answer is cached by the client. If the
+    # CapabilityStatement cannot be retrieved, the server is assumed
+    # to support transactions.
+    def is_transaction_supported(self):
+        if self.transactions_supported == None:
+            try:
+                r = requests.get('%s/metadata' % self.url, auth = self.auth)
+                r.raise_for_status()
+                capabilities = r.json()
+            except (requests.exceptions.RequestException, ValueError):
+                return True  # Unknown, will be checked again on the next call
+
+            supported = False
+            for rest in capabilities.get('rest', []):
+                for interaction in rest.get('interaction', []):
+                    if interaction.get('code') == 'transaction':
+                        supported = True
+
+            self.transactions_supported = supported
+
+        return self.transactions_supported
+
+
+    # Create or update several FHIR resources at once, as one single
+    # atomic transaction Bundle (one round trip to the FHIR server).
+    # Check out "_build_bundle()" for the format of "entries". The
+    # method returns the list of the response entries, in the same
+    # order as "entries". The identifier of the created resources can
+    # be retrieved using "get_entry_id()". If the FHIR server does not
+    # support transactions and "emulate" is "True", the entries are
+    # sent one by one. The support of transactions is read from the
+    # CapabilityStatement of the server, or deduced from a response
+    # rejecting the operation itself (as opposed to an invalid Bundle),
+    # and is remembered by the client.
+    def transaction(self, entries, emulate = True):
+        bundle = self._build_bundle('transaction', entries)
+
+        if emulate and not self.is_transaction_supported():
+            return self._emulate_transaction(bundle)
+
+        try:
+            return self._post_bundle(bundle)
+        except requests.exceptions.HTTPError as e:
+            if emulate and _is_unsupported_operation(e.response):
+                self.transactions_supported = False
+                return self._emulate_transaction(bundle)
+            else:
+                raise
+
+
+    # Same as "transaction()", but as a batch Bundle: The entries are
+    # processed independently of each other by the FHIR server (which
+    # implies that they cannot refer to each other), and the response
+    # entries provide the individual status of each entry.
+    def batch(self, entries):
+        return self._post_bundle(self._build_bundle('batch', entries))
+
+
+    # Return the FHIR identifier of the resource corresponding to one
+    # response entry of "transaction()" or "batch()"
+    @staticmethod
+    def get_entry_id(entry):
+        if 'resource' in entry and 'id' in entry['resource']:
+            return entry['resource']['id']
+
+        # The location has the form "Type/id/_history/version"
+        location = entry.get('response', {}).get('location', '')
+        parts = location.split('/')
+        if '_history' in parts:
+            parts = parts[0 : parts.index('_history')]
+
+        if len(parts) < 2:
+            raise Exception('No identifier in the FHIR response entry')
+        else:
+            return parts[-1]
+
+
+# HTTP statuses indicating that a FHIR server does not support
+# transaction Bundles
+_UNSUPPORTED_BUNDLE_STATUSES = [ 404, 405, 501 ]
+
+
+# Internal function telling whether an HTTP error response to a Bundle
+# means that the FHIR server does not support the operation. A "400
+# Bad Request" only means so if its OperationOutcome says so (HAPI,
+# which is used by OpenMRS, answers "does not know how to handle POST
+# operation"). Otherwise, the Bundle is invalid, and must not be
+# replayed entry by entry (which would not be atomic).
+def _is_unsupported_operation(response):
+    if response.status_code in _UNSUPPORTED_BUNDLE_STATUSES:
+        return True
+    elif response.status_code != 400:
+        return False
+
+    try:
+        outcome = response.json()
+    except ValueError:
+        return False
+
+    if not isinstance(outcome, dict) or outcome.get('resourceType') != 'OperationOutcome':
+        return False
+
+    for issue in outcome.get('issue', []):
+        diagnostics = issue.get('diagnostics', '').lower()
+        if (issue.get('code') == 'not-supported' or
+            'does not know how to handle' in diagnostics or
+            'not supported' in diagnostics):
+            return True
+
+    return False
+
+
+# Internal function replacing the temporary URLs in the references of
+# a FHIR resource (recursively), given a dictionary that maps the
+# temporary URLs to the actual references.
+def _replace_references(value, references):
+    if isinstance(value, dict):
+        result = {}
+        for (key, item) in value.items():
+            if key == 'reference' and isinstance(item, str) and item in references:
+                result[key] = references[item]
+            else:
+                result[key] = _replace_references(item, references)
+        return result
+    elif isinstance(value, list):
+        return [ _replace_references(item, references) for item in value ]
+    else:
+        return value
+
+
+# Class implementing a thread-safe cache of FHIR resources, with a
+# least-recently-used eviction policy to bound the memory usage.
+class ResourceCache:
+
+    def __init__(self, max_entries = 256):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.content = collections.OrderedDict()
+
+
+    # Return the value associated with some key, or "None" if absent
+    def get(self, key):
+        with self.lock:
+            value = self.content.get(key)
+            if value != None:
+                self.content.move_to_end(key)
+            return value
+
+
+    # Associate a value with some key, evicting the least recently
+    # used entries if the cache is full
+    def add(self, key, value):
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.content[key] = value
+            self.content.move_to_end(key)
+            while len(self.content) > self.max_entries:
+                self.content.popitem(last = False)
+
+
+    def remove(self, key):
+        with self.lock:
+            self.content.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.content.clear()
+
+
+# Class that stores the FHIR resources returned by one search,
+# indexed by their type and their identifier, so that the references
+# between them can be resolved in memory without contacting the FHIR
+# server.
+class ResourceGraph:
+
+    def __init__(self):
+        self.resources = {}  # Map from resource type to a map from identifier to resource
+        self.matches = []    # Resources that are matches of the search (i.e., not included)
+
+
+    # Add one FHIR resource to the graph
+    def add(self, resource, is_match = True):
+        resource_type = resource['resourceType']
+        if not resource_type in self.resources:
+            self.resources[resource_type] = {}
+        self.resources[resource_type][resource['id']] = resource
+
+        if is_match:
+            self.matches.append(resource)
+
+
+    # Return the resource with the given type and identifier, or
+    # "None" if it is not part of the graph
+    def get(self, resource_type, resource_identifier):
+        return self.resources.get(resource_type, {}).get(resource_identifier)
+
+
+    # List all the resources of a given type in the graph
+    def list(self, resource_type):
+        return list(self.resources.get(resource_type, {}).values())
+
+
+    # Return the resources that are matches of the search (i.e.,
+    # excluding the resources added by "_include" or "_revinclude")
+    def get_matches(self):
+        return self.matches
+
+
+    # Resolve a FHIR reference (either a "Reference" JSON object, or a
+    # string like "Encounter/1234", possibly as an absolute URL or
+    # with a "_history" suffix) into the corresponding resource of the
+    # graph. "None" is returned if the referenced resource is absent.
+    def resolve(self, reference):
+        target = parse_reference(reference)
+        if target == None:
+            return None
+        else:
+            return self.get(target[0], target[1])
+
+
+    # List the resources of type "resource_type" whose field "field"
+    # (e.g. "encounter" or "partOf") refers to the given resource
+    def find_referencing(self, resource_type, field, target):
+        result = []
+        for resource in self.resources.get(resource_type, {}).values():
+            reference = parse_reference(resource.get(field))
+            if (reference != None and
+                reference[0] == target['resourceType'] and
+                reference[1] == target['id']):
+                result.append(resource)
+        return result
+
+
+# Parse a FHIR reference (either a "Reference" JSON object, or a
+# string), and return a tuple containing the type and the identifier
+# of the target resource. "None" is returned if the reference is not
+# a literal reference.
+def parse_reference(reference):
+    if isinstance(reference, dict):
+        reference = reference.get('reference')
+
+    if not isinstance(reference, str):
+        return None
+
+    parts = reference.split('/')
+    if '_history' in parts:
+        parts = parts[0 : parts.index('_history')]
+
+    if len(parts) < 2:
+        return None
+    else:
+        return (parts[-2], parts[-1])
@@ -24,9 +24,11 @@
 
 
 import base64
+import collections
 import datetime
 import json
 import requests
+import threading
 
 
 # These default values are suitable for OpenMRS Reference Application 2.13
@@ -47,10 +49,14 @@ class OpenMRSClient:
 
     # Constructor for the connection: An URL, an username, and a
     # password are expected.
+    # The "identifier_pool_size" parameter sets how many OpenMRS IDs
+    # are generated at once by the ID generator of OpenMRS, the unused
+    # identifiers being kept for the next patients.
     def __init__(self,
                  url = 'http://localhost:8003/openmrs/ws/rest',
                  username = 'admin',
-                 password = 'Admin123'):
+                 password = 'Admin123',
+                 identifier_pool_size = 1):
         # Make sure that the URL does not end with a slash
         if url.endswith('/'):
             self.url = url[0 : len(url) - 1]
@@ -58,17 +64,32 @@ class OpenMRSClient:
             self.url = url
 
         self.auth = requests.auth.HTTPBasicAuth(username, password)
+        self.lock = threading.Lock()
+        self.identifier_pool_size = max(1, identifier_pool_size)
+        self.identifier_pool = collections.deque()
+        self.identifier_source = None
+        self.fhir_metadata = None
 
 
-    # Internal method to look for the UUID of a resource given its
-    # display name, inside a table of the OpenMRS data model.
-    def _lookup_entity(self, table, display_name):
+    # Internal method returning a dictionary that maps the display
+    # names to the UUIDs of all the entities of a table of the OpenMRS
+    # data model.
+    def _list_entities(self, table):
         r = requests.get('%s/v1/%s' % (self.url, table), auth = self.auth)
         r.raise_for_status()
 
-        for result in r.json() ['results']:
-            if result['display'] == display_name:
-                return result['uuid']
+        result = {}
+        for entity in r.json() ['results']:
+            result.setdefault(entity['display'], entity['uuid'])  # Keep the first match
+        return result
+
+
+    # Internal method to look for the UUID of a resource given its
+    # display name, inside a table of the OpenMRS data model.
+    def _lookup_entity(self, table, display_name):
+        entities = self._list_entities(table)
+        if display_name in entities:
+            return entities[display_name]
 
         raise Exception('Unable to find entity with display name "%s" in table "%s"' %
                         (table, display_name))
@@ -86,22 +107,38 @@ class OpenMRSClient:
         
 
     # Internal method to generate a new patient OpenMRS identifier.
+    # The identifiers are taken from a pool, which is refilled with
+    # "identifier_pool_size" identifiers by one single request to the
+    # ID generator whenever it becomes empty.
     def _generate_patient_identifier(self):
-        r = requests.get('%s/v1/idgen/identifiersource' % self.url, auth = self.auth)
-        r.raise_for_status()
+        with self.lock:
+            if len(self.identifier_pool) == 0:
+                if self.identifier_source == None:
+                    r = requests.get('%s/v1/idgen/identifiersource' % self.url, auth = self.auth)
+                    r.raise_for_status()
+
+                    generator = r.json() ['results'][0]  # Use the first available generator
+                    self.identifier_source = (generator['uuid'], generator['identifierType']['uuid'])
+
+                content = {
+                    'generateIdentifiers': True,
+                    'sourceUuid': self.identifier_source[0],
+                    'numberToGenerate': self.identifier_pool_size,
+                }
 
-        generator = r.json() ['results'][0]  # Use the first available generator
+                r = self._do_post_json('/v1/idgen/identifiersource', content)
+                for identifier in r['identifiers']:
+                    self.identifier_pool.append((self.identifier_source[1], identifier))
 
-        identifierType = generator['identifierType']['uuid']
+                if len(self.identifier_pool) == 0:
+                    raise Exception('The ID generator of OpenMRS has returned no identifier')
 
-        content = {
-            'generateIdentifiers': True,
-            'sourceUuid': generator['uuid'],
-            'numberToGenerate': 1,
-        }
+            return self.identifier_pool.popleft()
 
-        r = self._do_post_json('/v1/idgen/identifiersource', content)
-        return (identifierType, r['identifiers'][0])
+
+    # Return a new OpenMRS ID, taken from the pool of identifiers
+    def generate_patient_identifier(self):
+        return self._generate_patient_identifier()[1]
 
 
     # Internal method to convert a Python "datetime" structure as a
@@ -117,7 +154,7 @@ class OpenMRSClient:
     # Retrieve the current "datetime" in a format that can be used in
     # the REST API of OpenMRS.
     def format_now(self):
-        return self._format_date_time(datetime.datetime.utcnow())
+        return _format_now()
 
 
     # Parse a string field returned by OpenMRS that contains a "datetime".
@@ -463,49 +500,41 @@ class OpenMRSClient:
         return False
 
 
+    # Retrieve the UUIDs of the OpenMRS entities that are needed to
+    # create FHIR resources (locations, visit types, encounter types,
+    # and the given concepts), as a "FHIRMetadata" object. This
+    # results in one request per table and one request per concept.
+    def load_fhir_metadata(self, concepts = []):
+        result = FHIRMetadata(locations = self._list_entities('location'),
+                              visit_types = self._list_entities('visittype'),
+                              encounter_types = self._list_entities('encountertype'))
+        for concept in concepts:
+            result.concepts[concept] = self.lookup_concept(concept)
+        return result
+
+
+    # Return the "FHIRMetadata" of this client, which is loaded only
+    # once. The concepts that are not known yet are looked up.
+    def get_fhir_metadata(self, concepts = []):
+        with self.lock:
+            if self.fhir_metadata == None:
+                self.fhir_metadata = self.load_fhir_metadata()
+
+            for concept in concepts:
+                if not concept in self.fhir_metadata.concepts:
+                    self.fhir_metadata.concepts[concept] = self.lookup_concept(concept)
+
+            return self.fhir_metadata
+
+
     # Create the skeleton of a JSON file encoding a "Patient" FHIR
     # resource, containing the minimal information required by the
-    # FHIR implementation of OpenMRS.
+    # FHIR implementation of OpenMRS. A new OpenMRS ID is taken from
+    # the pool of identifiers.
     def create_fhir_patient_json(self, given_name, family_name, gender, birth_date,
                                  location = _DEFAULT_LOCATION):
-        if not gender in [ 'male', 'female', 'unknown' ]:
-            raise Exception('Invalid patient gender: %s' % gender)
-
-        location_uuid = self._lookup_entity('location', location)
-        identifier = self._generate_patient_identifier()
-
-        fhir_identifer = [
-            {
-                'extension': [
-                    {
-                        'url': 'http://fhir.openmrs.org/ext/patient/identifier#location',
-                        'valueReference': {
-                            'reference': 'Location/%s' % location_uuid,
-                            'type': 'Location',
-                            'display': location,
-                        }
-                    }
-                ],
-                'use': 'official',
-                'type': {
-                    'text': 'OpenMRS ID',
-                },
-                'value': identifier[1],
-            }
-        ]
-
-        return {
-            'resourceType' : 'Patient',
-            'gender' : gender,
-            'name' : [
-                {
-                    'family' : family_name,
-                    'given' : given_name,
-                }
-            ],
-            'birthDate' : birth_date,
-            'identifier' : fhir_identifer,
-        }
+        return build_fhir_patient_json(self.get_fhir_metadata(), self.generate_patient_identifier(),
+                                       given_name, family_name, gender, birth_date, location)
 
 
     # Create the skeleton of a JSON file encoding a "Encounter" FHIR
@@ -513,29 +542,7 @@ class OpenMRSClient:
     def create_fhir_visit_json(self, patient_uuid,
                                visit_type = _DEFAULT_VISIT_TYPE,
                                start_date_time = None):
-        if start_date_time == None:
-            start_date_time = self.format_now()
-
-        return {
-            'resourceType' : 'Encounter',
-            'subject' : {
-                'reference' : 'Patient/%s' % patient_uuid,
-            },
-            'period' : {
-                'start' : start_date_time,
-            },
-            'type': [
-                {
-                    'coding': [
-                        {
-                            'code': self._lookup_entity('visittype', visit_type),
-                            'display': visit_type,
-                            'system': 'http://fhir.openmrs.org/code-system/visit-type',
-                        }
-                    ]
-                }
-            ],
-        }
+        return build_fhir_visit_json(self.get_fhir_metadata(), patient_uuid, visit_type, start_date_time)
 
 
     # Create the skeleton of a JSON file encoding a "Encounter" FHIR
@@ -544,32 +551,8 @@ class OpenMRSClient:
     # "encounter_type" can be "Vitals", "Attachment Upload", or "Visit Note".
     def create_fhir_encounter_json(self, patient_uuid, visit_uuid, encounter_type,
                                    date_time = None):
-        if date_time == None:
-            date_time = self.format_now()
-
-        return {
-            'resourceType' : 'Encounter',
-            'partOf' : {
-                'reference' : 'Encounter/%s' % visit_uuid,
-            },
-            'subject' : {
-                'reference' : 'Patient/%s' % patient_uuid,
-            },
-            'period' : {
-                'start' : date_time,
-            },
-            'type': [
-                {
-                    'coding': [
-                        {
-                            'code' : self._lookup_entity('encountertype', encounter_type),
-                            'display' : encounter_type,
-                            'system' : 'http://fhir.openmrs.org/code-system/encounter-type',
-                        }
-                    ]
-                }
-            ],
-        }
+        return build_fhir_encounter_json(self.get_fhir_metadata(), patient_uuid, visit_uuid,
+                                         encounter_type, date_time)
 
 
     # Create the skeleton of a JSON file encoding a "Observation" FHIR
@@ -581,24 +564,182 @@ class OpenMRSClient:
     # it is up to the caller to fill the "value[x]" field.
     def create_fhir_observation_json(self, patient_uuid, encounter_uuid, concept_name,
                                      date_time = None):
-        if date_time == None:
-            date_time = self.format_now()
+        return build_fhir_observation_json(self.get_fhir_metadata([ concept_name ]), patient_uuid,
+                                           encounter_uuid, concept_name, date_time)
+
+
+# Class containing the UUIDs of the OpenMRS entities that are
+# referred to by the FHIR resources, indexed by their display name.
+# Once loaded (cf. "OpenMRSClient.load_fhir_metadata()"), it can be
+# shared by all the requests, so that the "build_fhir_*_json()"
+# functions below never have to contact OpenMRS.
+class FHIRMetadata:
+
+    def __init__(self, locations = {}, visit_types = {}, encounter_types = {}, concepts = {}):
+        self.locations = dict(locations)
+        self.visit_types = dict(visit_types)
+        self.encounter_types = dict(encounter_types)
+        self.concepts = dict(concepts)
+
+
+    # Internal method to look for an entity given its display name
+    @staticmethod
+    def _get(entities, kind, display_name):
+        uuid = entities.get(display_name)
+        if uuid == None:
+            raise Exception('Unknown %s: %s' % (kind, display_name))
+        else:
+            return uuid
+
+    def get_location(self, name):
+        return self._get(self.locations, 'location', name)
+
+    def get_visit_type(self, name):
+        return self._get(self.visit_types, 'visit type', name)
 
-        return {
-            'resourceType' : 'Observation',
-            'code' : {
-                'coding' : [
+    def get_encounter_type(self, name):
+        return self._get(self.encounter_types, 'encounter type', name)
+
+    def get_concept(self, name):
+        return self._get(self.concepts, 'concept', name)
+
+
+# Internal function returning the current "datetime" in a format that
+# can be used by OpenMRS (without milliseconds nor microseconds). It
+# is shared by "OpenMRSClient.format_now()" and the builders below.
+def _format_now():
+    return datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+
+
+# Create the skeleton of a JSON file encoding a "Patient" FHIR
+# resource, given the "FHIRMetadata" and the OpenMRS ID of the
+# patient. This function doesn't contact OpenMRS.
+def build_fhir_patient_json(metadata, identifier, given_name, family_name, gender, birth_date,
+                            location = _DEFAULT_LOCATION):
+    if not gender in [ 'male', 'female', 'unknown' ]:
+        raise Exception('Invalid patient gender: %s' % gender)
+
+    return {
+        'resourceType' : 'Patient',
+        'gender' : gender,
+        'name' : [
+            {
+                'family' : family_name,
+                'given' : given_name,
+            }
+        ],
+        'birthDate' : birth_date,
+        'identifier' : [
+            {
+                'extension': [
                     {
-                        'code' : self.lookup_concept(concept_name),
+                        'url': 'http://fhir.openmrs.org/ext/patient/identifier#location',
+                        'valueReference': {
+                            'reference': 'Location/%s' % metadata.get_location(location),
+                            'type': 'Location',
+                            'display': location,
+                        }
+                    }
+                ],
+                'use': 'official',
+                'type': {
+                    'text': _OPENMRS_ID,
+                },
+                'value': identifier,
+            }
+        ],
+    }
+
+
+# Create the skeleton of a JSON file encoding a "Encounter" FHIR
+# resource corresponding to a visit in OpenMRS for the given patient.
+# This function doesn't contact OpenMRS.
+def build_fhir_visit_json(metadata, patient_uuid,
+                          visit_type = _DEFAULT_VISIT_TYPE,
+                          start_date_time = None):
+    if start_date_time == None:
+        start_date_time = _format_now()
+
+    return {
+        'resourceType' : 'Encounter',
+        'subject' : {
+            'reference' : 'Patient/%s' % patient_uuid,
+        },
+        'period' : {
+            'start' : start_date_time,
+        },
+        'type': [
+            {
+                'coding': [
+                    {
+                        'code': metadata.get_visit_type(visit_type),
+                        'display': visit_type,
+                        'system': 'http://fhir.openmrs.org/code-system/visit-type',
                     }
                 ]
-            },
-            'effectiveDateTime': date_time,
-            'encounter' : {
-                'reference' : 'Encounter/%s' % encounter_uuid,
-            },
-            'status' : 'final',
-            'subject': {
-                'reference': 'Patient/%s' % patient_uuid,
-            },
-        }
+            }
+        ],
+    }
+
+
+# Create the skeleton of a JSON file encoding a "Encounter" FHIR
+# resource corresponding to an encounter in OpenMRS for the given
+# patient and visit. This function doesn't contact OpenMRS.
+def build_fhir_encounter_json(metadata, patient_uuid, visit_uuid, encounter_type,
+                              date_time = None):
+    if date_time == None:
+        date_time = _format_now()
+
+    return {
+        'resourceType' : 'Encounter',
+        'partOf' : {
+            'reference' : 'Encounter/%s' % visit_uuid,
+        },
+        'subject' : {
+            'reference' : 'Patient/%s' % patient_uuid,
+        },
+        'period' : {
+            'start' : date_time,
+        },
+        'type': [
+            {
+                'coding': [
+                    {
+                        'code' : metadata.get_encounter_type(encounter_type),
+                        'display' : encounter_type,
+                        'system' : 'http://fhir.openmrs.org/code-system/encounter-type',
+                    }
+                ]
+            }
+        ],
+    }
+
+
+# Create the skeleton of a JSON file encoding a "Observation" FHIR
+# resource corresponding to an observation of a concept, for the
+# given patient and encounter. The concept must be part of the
+# "FHIRMetadata". It is up to the caller to fill the "value[x]"
+# field. This function doesn't contact OpenMRS.
+def build_fhir_observation_json(metadata, patient_uuid, encounter_uuid, concept_name,
+                                date_time = None):
+    if date_time == None:
+        date_time = _format_now()
+
+    return {
+        'resourceType' : 'Observation',
+        'code' : {
+            'coding' : [
+                {
+                    'code' : metadata.get_concept(concept_name),
+                }
+            ]
+        },
+        'effectiveDateTime': date_time,
+        'encounter' : {
+            'reference' : 'Encounter/%s' % encounter_uuid,
+        },
+        'status' : 'final',
+        'subject': {
+            'reference': 'Patient/%s' % patient_uuid,
+        },
+    }
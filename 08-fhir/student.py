@@ -41,11 +41,16 @@ import OpenMRSClient
 import flask
 import json
 import pprint
+import requests
+import threading
 
 app = flask.Flask(__name__)
 
 
 global_credentials = None
+global_fhir_client = None  # Shared across requests, so that its resource cache is reused
+global_openmrs_client = None  # Shared across requests, so that its pool of OpenMRS IDs is reused
+global_clients_lock = threading.Lock()
 
 @app.route('/')
 def redirection():
@@ -75,8 +80,54 @@ def get_javascript():
 # that can be used are related to entity discovery (cf. the methods in
 # class "OpenMRSClient" whose name contain "_fhir_").
 def app_initialize(credentials):
-    global global_credentials
+    global global_credentials, global_fhir_client, global_openmrs_client
     global_credentials = credentials
+    with global_clients_lock:
+        global_fhir_client = None
+        global_openmrs_client = None
+
+
+# Mapping from the genders of the Web interface to the FHIR genders
+_GENDERS = {
+    'M' : 'male',
+    'F' : 'female',
+}
+
+
+def _get_fhir_client():
+    global global_fhir_client
+    with global_clients_lock:
+        if global_fhir_client == None:
+            global_fhir_client = FHIRClient.FHIRClient(url = global_credentials['fhir-url'],
+                                                       username = global_credentials['username'],
+                                                       password = global_credentials['password'])
+        return global_fhir_client
+
+
+def _get_openmrs_client():
+    global global_openmrs_client
+    with global_clients_lock:
+        if global_openmrs_client == None:
+            global_openmrs_client = OpenMRSClient.OpenMRSClient(url = global_credentials['openmrs-url'],
+                                                                username = global_credentials['username'],
+                                                                password = global_credentials['password'],
+                                                                identifier_pool_size = 20)
+        return global_openmrs_client
+
+
+# Return the FHIR identifier of the single visit of a patient. An
+# exception is raised if the patient has no visit, or has multiple
+# visits.
+def _find_visit(fhir, openmrs, patient_uuid):
+    visits = []
+    for encounter in fhir.iter_resources('Encounter', { 'subject' : patient_uuid }):
+        if openmrs.is_fhir_encounter_a_visit(encounter):
+            visits.append(encounter['id'])
+
+    if len(visits) != 1:
+        raise Exception('Patient %s must have exactly one visit, found %d' % (patient_uuid, len(visits)))
+    else:
+        return visits[0]
 
 
 @app.route('/create-patient', methods = [ 'POST' ])
@@ -104,9 +155,31 @@ def create_patient():
     #   "patient-uuid": "c7c64b80-e5ee-40a3-8137-5df23c45575d",
     #   "visit-uuid": "a355bb40-b704-4df9-a392-12d7aa3aa631"
     # }
+    body = flask.request.get_json()
 
-    # TODO
-    return flask.Response('Not Implemented\n', 501)
+    fhir = _get_fhir_client()
+    openmrs = _get_openmrs_client()
+
+    patient_url = fhir.generate_temporary_url()
+    metadata = openmrs.get_fhir_metadata([ 'Text of encounter note' ])
+    patient = OpenMRSClient.build_fhir_patient_json(metadata, openmrs.generate_patient_identifier(),
+                                                    body['given-name'], body['family-name'],
+                                                    _GENDERS.get(body['gender'], 'unknown'),
+                                                    body['birth-date'])
+
+    visit = OpenMRSClient.build_fhir_visit_json(metadata, None)
+    visit['subject']['reference'] = patient_url
+
+    # Create both the patient and the visit in one single round trip
+    response = fhir.transaction([
+        { 'fullUrl' : patient_url, 'resource' : patient },
+        visit,
+    ])
+
+    return flask.jsonify({
+        'patient-uuid' : fhir.get_entry_id(response[0]),
+        'visit-uuid' : fhir.get_entry_id(response[1]),
+    })
 
 
 @app.route('/find-patients', methods = [ 'POST' ])
@@ -163,9 +236,32 @@ def record_note():
     #   "encounter-uuid": "4cece72b-d677-4b77-90f1-1cb201e8a727",
     #   "observation-uuid": "04ad9388-fb27-4494-a9f3-78ab44a79181"
     # }
+    body = flask.request.get_json()
+    patient_uuid = body['patient-uuid']
 
-    # TODO
-    return flask.Response('Not Implemented\n', 501)
+    fhir = _get_fhir_client()
+    openmrs = _get_openmrs_client()
+
+    visit_uuid = _find_visit(fhir, openmrs, patient_uuid)
+
+    encounter_url = fhir.generate_temporary_url()
+    metadata = openmrs.get_fhir_metadata([ 'Text of encounter note' ])
+    encounter = OpenMRSClient.build_fhir_encounter_json(metadata, patient_uuid, visit_uuid, 'Visit Note')
+
+    observation = OpenMRSClient.build_fhir_observation_json(metadata, patient_uuid, None, 'Text of encounter note')
+    observation['encounter']['reference'] = encounter_url
+    observation['valueString'] = body['text']
+
+    # Create both the encounter and the observation in one single round trip
+    response = fhir.transaction([
+        { 'fullUrl' : encounter_url, 'resource' : encounter },
+        observation,
+    ])
+
+    return flask.jsonify({
+        'encounter-uuid' : fhir.get_entry_id(response[0]),
+        'observation-uuid' : fhir.get_entry_id(response[1]),
+    })
 
 
 @app.route('/notes', methods = [ 'GET' ])
@@ -202,9 +298,85 @@ def list_notes():
     # }
     #
     # The "notes" array must be sorted by decreasing values of "time".
+    patient_uuid = flask.request.args.get('patient-uuid')
+    if patient_uuid == None or patient_uuid == '':
+        return flask.Response('Missing argument: patient-uuid\n', 400)
 
-    # TODO
-    return flask.Response('Not Implemented\n', 501)
+    fhir = _get_fhir_client()
+    openmrs = _get_openmrs_client()
+
+    # Retrieve the patient, together with all its encounters and
+    # observations, in one single FHIR search. An unknown patient
+    # results in an empty search, but some servers answer 404 or 410.
+    try:
+        graph = fhir.search('Patient', { '_id' : patient_uuid },
+                            revinclude = [ 'Encounter:patient', 'Observation:patient' ])
+    except requests.exceptions.HTTPError as e:
+        if e.response != None and e.response.status_code in [ 404, 410 ]:
+            return flask.Response('Unknown patient: %s\n' % patient_uuid, 404)
+        else:
+            raise
+
+    patient = graph.get('Patient', patient_uuid)
+    if patient == None:
+        return flask.Response('Unknown patient: %s\n' % patient_uuid, 404)
+
+    visits = []
+    for encounter in graph.list('Encounter'):
+        if openmrs.is_fhir_encounter_a_visit(encounter):
+            visits.append(encounter)
+
+    if len(visits) != 1:
+        raise Exception('Patient %s must have exactly one visit, found %d' % (patient_uuid, len(visits)))
+
+    concept = openmrs.get_fhir_metadata([ 'Text of encounter note' ]).get_concept('Text of encounter note')
+
+    notes = []
+    for encounter in graph.find_referencing('Encounter', 'partOf', visits[0]):
+        for observation in graph.find_referencing('Observation', 'encounter', encounter):
+            codes = [ coding.get('code') for coding in observation.get('code', {}).get('coding', []) ]
+            if concept in codes:
+                notes.append({
+                    'text' : observation.get('valueString'),
+                    'time' : observation.get('effectiveDateTime'),
+                })
+
+    notes.sort(key = lambda note: note['time'], reverse = True)
+
+    return flask.jsonify({
+        'notes' : notes,
+        'patient' : _format_patient_info(patient, visits[0]['id']),
+    })
+
+
+# Mapping from the FHIR genders to the genders of the Web interface
+_REVERSE_GENDERS = {
+    'male' : 'M',
+    'female' : 'F',
+}
+
+
+# Extract the demographic information about a patient, from its
+# "Patient" FHIR resource
+def _format_patient_info(patient, visit_uuid):
+    identifier = None
+    for item in patient.get('identifier', []):
+        if item.get('type', {}).get('text') == 'OpenMRS ID':
+            identifier = item.get('value')
+            break
+
+    name = patient.get('name', [ {} ])[0]
+    given = name.get('given', [])
+    if isinstance(given, str):
+        given = [ given ]
+
+    return {
+        'birth-date' : patient.get('birthDate'),
+        'gender' : _REVERSE_GENDERS.get(patient.get('gender'), 'U'),
+        'id' : identifier,
+        'name' : ' '.join(given + [ name.get('family', '') ]).strip(),
+        'visit-uuid' : visit_uuid,
+    }
 
 
 if __name__ == '__main__':